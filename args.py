@@ -3,7 +3,7 @@ import json
 import argparse
 from functools import partial
 import numpy as np
-import tensorflow as tf
+from data.image_cache import set_cache_budget
 
 def argument_parser():
     """
@@ -24,6 +24,14 @@ def argument_parser():
     parser.add_argument('--save_interval', type=int, default=10, help='Every how many epochs to write checkpoint/samples?')
     parser.add_argument('--load_params', dest='load_params', action='store_true', help='Restore training from previous model checkpoint?')
     parser.add_argument('--dataset_name', help='name of dataset', default='gpsamples')
+    parser.add_argument('--point_set_inputs', help='feed one point set per task and split context/target in the graph', action='store_true', default=False)
+    parser.add_argument('--image_cache_mb', help='memory budget of the decoded image cache (image datasets read from files)', default=1024, type=int)
+    parser.add_argument('--prefetch', help='number of meta-batches prepared ahead in background threads (0 to sample on the main thread)', default=0, type=int)
+    parser.add_argument('--prefetch_threads', help='number of threads preparing meta-batches', default=1, type=int)
+    parser.add_argument('--prefetch_processes', help='number of worker processes sampling meta-batches into shared memory (0 to use threads)', default=0, type=int)
+    parser.add_argument('--input_pipeline', help='how training episodes reach the models: feed (feed_dict) | tfdata (padded episodes from a tf.data pipeline)', default='feed', choices=['feed', 'tfdata'])
+    parser.add_argument('--episode_records', help='glob of episode TFRecord files read by the tfdata pipeline (sampled on the fly if not given)', default=None)
+    parser.add_argument('--in_graph_tasks', help='generate training tasks in the graph (sinusoid and gpsamples only)', action='store_true', default=False)
     #
     parser.add_argument('--learning_rate', type=float, default=0.001, help='Base learning rate')
     parser.add_argument('--alpha', type=float, default=0.1, help='Inner step size')
@@ -45,10 +53,19 @@ def argument_parser():
     parser.add_argument('--eval_iters', help='eval inner iterations', default=50, type=int)
     parser.add_argument('--eval_samples', help='evaluation samples', default=10000, type=int)
     parser.add_argument('--eval_interval', help='train steps per eval', default=5, type=int)
+    parser.add_argument('--eval_seed', help='seed evaluation tasks for common random numbers across checkpoints', default=None, type=int)
+    parser.add_argument('--eval_input_sampling', help='input locations of evaluation tasks: uniform | stratified | sobol (sinusoid and gpsamples; sobol not for stored GP functions)', default='uniform')
+    parser.add_argument('--antithetic', help='evaluate with antithetic latent draws', action='store_true', default=False)
     return parser
 
 def prepare_args(args):
     print("Prepare args ......")
+    print("\t* check input options")
+    inputs = [name for name, used in [("--in_graph_tasks", args.in_graph_tasks), ("--point_set_inputs", args.point_set_inputs), ("--input_pipeline tfdata", args.input_pipeline == 'tfdata')] if used]
+    if len(inputs) > 1:
+        raise Exception("{0} cannot be combined".format(" and ".join(inputs)))
+    if args.episode_records is not None and args.input_pipeline != 'tfdata':
+        raise Exception("--episode_records is only read with --input_pipeline tfdata")
     print("\t* infer nr_gpu")
     args.nr_gpu = len(args.gpus.split(","))
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
@@ -59,14 +76,18 @@ def prepare_args(args):
     if not os.path.exists(args.output_dir) and args.output_dir!="":
         os.makedirs(args.output_dir)
     print("\t* set random seed {0} for numpy and tensorflow".format(args.seed))
+    import tensorflow as tf
     tf.set_random_seed(args.seed)
     np.random.seed(args.seed)
+    print("\t* set image cache budget to {0}MB".format(args.image_cache_mb))
+    set_cache_budget(args.image_cache_mb * 2**20)
 
     print('Input args:\n', json.dumps(vars(args), indent=4, separators=(',',':'))) # pretty print args
     return args
 
 
 def model_kwards(model_name, parse_args, user_set_args={}):
+    import tensorflow as tf
     if model_name == 'omniglot':
         params = {
             "img_size": parse_args.img_size,
@@ -3,8 +3,8 @@ import sys
 import random
 from PIL import Image
 import numpy as np
-import tensorflow as tf
-import misc.helpers as helpers
+from data.packed import write_packed, read_packed, packed_exists
+from data.sampling import EpochPermutation, get_rng
 
 
 def read_imgs(dir, limit=-1):
@@ -30,48 +30,126 @@ def load(data_dir="/data/ziz/not-backed-up/jxu/CelebA", subset='train', size=64,
         raise NotImplementedError('subset should be either train, valid or test')
 
 
+def packed_path(data_dir, subset, size):
+    return os.path.join(data_dir, "celeba{0}-{1}-packed".format(size, subset))
+
+def read_packed_image(path):
+    return np.array(Image.open(path)).astype(np.uint8)
+
+def pack_celeba(data_dir, size=32, processes=None):
+    """
+    Decode the train, valid and test images of one resolution into one
+    packed uint8 store per subset (see data.packed), in filename order as
+    read_imgs does.
+    """
+    for subset in ['train', 'valid', 'test']:
+        img_dir = os.path.join(data_dir, "celeba{0}-{1}-new".format(size, subset))
+        filenames = sorted(f for f in os.listdir(img_dir) if not f.startswith('.'))
+        shape = read_packed_image(os.path.join(img_dir, filenames[0])).shape
+        index = {"subset": subset, "size": size, "filenames": filenames}
+        write_packed(packed_path(data_dir, subset, size), [os.path.join(img_dir, f) for f in filenames], shape,
+                     read_packed_image, index, processes=processes)
+
+
 class CelebA(object):
 
-    def __init__(self, data_dir, which_set, dataset_name="celeba"):
+    # sample_batch draws whole meta-batches as padded arrays, see MetaLearner
+    batched_sampling = True
+
+    def __init__(self, data_dir, which_set, dataset_name="celeba", size=32):
+        """
+        Faces are memory-mapped from the packed store of the resolution if
+        pack_celeba has been run, otherwise a limited number of them are
+        read from the image files.
+        """
         self.data_dir = data_dir
         self.which_set = which_set
         self.dataset_name = dataset_name
 
-        if which_set == 'train':
-            self.images = load(self.data_dir, subset=which_set, size=32, limit=10000)[0]
-        elif which_set == 'val':
-            self.images = load(self.data_dir, subset="valid", size=32, limit=2000)[0]
-        elif which_set == 'test':
-            self.images = load(self.data_dir, subset=which_set, size=32, limit=500)[0]
-        else:
+        limits = {'train': 10000, 'val': 2000, 'test': 500}
+        if which_set not in limits:
             raise Exception("unknown {0}".format(which_set))
+        subset = "valid" if which_set == 'val' else which_set
+        if packed_exists(packed_path(self.data_dir, subset, size)):
+            self.images = read_packed(packed_path(self.data_dir, subset, size))[0]
+        else:
+            self.images = load(self.data_dir, subset=subset, size=size, limit=limits[which_set])[0]
+        self._perm = EpochPermutation(self.images.shape[0])
 
-    def sample(self, num):
+    def sample(self, num, rng=None):
         tasks = []
-        idxs = np.random.choice(self.images.shape[0], size=num, replace=False).astype(np.int32)
+        idxs = self._perm.next(num, rng)
         for i in idxs:
-            tasks.append(FaceCurve(self.images[i]))
+            tasks.append(FaceCurve(self.images[i], index=i))
         return tasks
 
+    def sample_batch(self, num, num_shots, test_shots, rng=None):
+        """
+        Sample a whole meta-batch of image completion tasks at once.
+        Args:
+          num: number of tasks B.
+          num_shots, test_shots: ints, or sequences of length B with per-task counts.
+        Returns:
+          A tuple (xs, ys, num_shots, test_shots). xs is a float32 array of
+          pixel coordinates of shape [B, N, 2] and ys one of grayscale values
+          of shape [B, N, 1], N being the largest num_shots+test_shots in the
+          batch. The N pixels of a task are distinct and in random order, so
+          task i uses the first num_shots[i] as context and the next
+          test_shots[i] as target.
+        """
+        num_shots = np.broadcast_to(np.asarray(num_shots, dtype=np.int32), (num,))
+        test_shots = np.broadcast_to(np.asarray(test_shots, dtype=np.int32), (num,))
+        num_samples = int(np.max(num_shots + test_shots))
+        images = self.images[np.sort(self._perm.next(num, rng))]
+        bs = to_grayscale(images).reshape((num, -1))
+        # the N smallest of uniform keys are a uniform subset, sorting them
+        # by key makes every prefix a uniform subset too
+        keys = get_rng(rng).uniform(size=bs.shape)
+        idx = np.argpartition(keys, num_samples-1, axis=1)[:, :num_samples]
+        idx = np.take_along_axis(idx, np.argsort(np.take_along_axis(keys, idx, axis=1), axis=1), axis=1)
+        xs = pixel_grid(images.shape[1])[idx]
+        ys = np.take_along_axis(bs, idx, axis=1)[:, :, None]
+        return xs, ys, num_shots, test_shots
+
+
+def pixel_grid(size):
+    """
+    Coordinates (column, row) / size of the pixels of a size x size image in
+    row-major order, as a float32 array of shape [size*size, 2]. Computed
+    once per size.
+    """
+    if size not in _pixel_grids:
+        xs, ys = np.meshgrid(np.arange(size), np.arange(size))
+        _pixel_grids[size] = np.stack([xs.flatten(), ys.flatten()], axis=-1).astype(np.float32) / size
+    return _pixel_grids[size]
+
+_pixel_grids = {}
+
+def to_grayscale(images):
+    return np.mean(images.astype(np.float32), axis=-1) / 255.
+
 
 class FaceCurve(object):
 
-    def __init__(self, image):
-        self.image = image
-        self.image = np.mean(self.image.astype(np.float32), axis=-1) / 255.
-        self.xs, self.ys = np.meshgrid(np.arange(32), np.arange(32))
-        self.xs = self.xs.astype(np.int32) / 32.
-        self.ys = self.ys.astype(np.int32) / 32.
-        self.xs = np.ndarray.flatten(self.xs)
-        self.ys = np.ndarray.flatten(self.ys)
-        self.cs = np.stack([self.xs, self.ys], axis=-1)
+    def __init__(self, image, index=None):
+        self.index = index
+        self.image = to_grayscale(image)
+        self.cs = pixel_grid(self.image.shape[0])
+        self.xs, self.ys = self.cs[:, 0], self.cs[:, 1]
         self.bs = np.ndarray.flatten(self.image)
         self.num_total_pixels = len(self.xs)
 
-    def sample(self, num_shots, test_shots):
-        idx = np.random.choice(self.num_total_pixels, size=num_shots+test_shots, replace=False).astype(np.int32)
+    def sample_pixels(self, num_pixels, rng=None):
+        return get_rng(rng).choice(self.num_total_pixels, size=num_pixels, replace=False).astype(np.int32)
+
+    def sample(self, num_shots, test_shots, rng=None):
+        idx = self.sample_pixels(num_shots+test_shots, rng)
         return self.cs[idx][:num_shots], self.bs[idx][:num_shots], self.cs[idx][num_shots:], self.bs[idx][num_shots:]
 
+    def sample_points(self, num_samples, rng=None):
+        idx = self.sample_pixels(num_samples, rng)
+        return self.cs[idx], self.bs[idx]
+
     def show(self, bs=None, cs=None):
         if bs is None:
             bs = self.bs
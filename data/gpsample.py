@@ -1,56 +1,320 @@
+import os
+import json
 import numpy as np
-import tensorflow as tf
+from data.sampling import EpochPermutation, get_rng, sample_inputs, stratified_choice
 
 # refer to https://gist.github.com/neubig/e859ef0cc1a63d1c2ea4
 
 class GPSample(object):
 
-    def __init__(self, input_range, var_range, max_num_samples=200, data=None, dataset_name="gpsamples"):
+    def __init__(self, input_range, var_range, max_num_samples=200, data=None, jitter=1e-6, num_features=None, input_sampling="uniform", dataset_name="gpsamples"):
+        """
+        If num_features is given (and data is None), functions are drawn from a
+        random Fourier feature approximation of the prior with that many features,
+        instead of exactly at max_num_samples locations.
+        """
         self.dataset_name = dataset_name
         self.input_range = input_range
         self.var_range = var_range
         self.max_num_samples = max_num_samples
+        self.jitter = jitter
+        self.num_features = num_features
+        if input_sampling == 'sobol' and (data is not None or num_features is None):
+            raise Exception("sobol input sampling needs lazily evaluated functions (num_features), not stored ones")
+        self.input_sampling = input_sampling
         self.data = data
         if data is not None:
             self.num_samples = self.data['xs'].shape[0]
+            self._perm = EpochPermutation(self.num_samples)
+        self._chol_cache = {}
 
-    def sample(self, num):
+    def sample(self, num, rng=None):
         if self.data is None:
-            return [self._sample_function(self.max_num_samples) for i in range(num)]
-        p = np.random.choice(self.num_samples, size=(num), replace=False)
-        return [GPFunction(xs=self.data['xs'][i][:,0], ys=self.data['ys'][i]) for i in p]
+            if self.num_features is not None:
+                return self.sample_rff(num, rng=rng)
+            return self.sample_functions(num, rng=rng)
+        p = self._perm.next(num, rng)
+        return [GPFunction(xs=self.data['xs'][i][:,0], ys=self.data['ys'][i], input_sampling=self.input_sampling) for i in p]
 
+    def reset(self):
+        """
+        Restart the function order from a fresh permutation (drawn from the
+        global RNG), so that seeded evaluations see the same functions.
+        """
+        if self.data is not None:
+            self._perm.reset()
+
+    def sample_functions(self, num, num_samples=None, xs=None, rng=None):
+        """
+        Sample functions from the GP prior using one batched Cholesky factorization.
+        Args:
+          num: number of functions.
+          num_samples: number of input locations per function (max_num_samples by default).
+          xs: optional array of shape [num_samples] shared by all functions. The
+            factorization is then computed once per distinct variance and reused
+            across calls.
+          rng: random stream, the global numpy RNG by default.
+        Returns:
+          A list of GPFunctions.
+        """
+        xs, ys = self.sample_arrays(num, num_samples, xs, rng)
+        return [GPFunction(xs[i], ys[i], input_sampling=self.input_sampling) for i in range(num)]
+
+    def sample_arrays(self, num, num_samples=None, xs=None, rng=None):
+        """
+        Same as sample_functions, but return the raw arrays xs and ys,
+        both of shape [num, num_samples].
+        """
+        rng = get_rng(rng)
+        if num_samples is None:
+            num_samples = self.max_num_samples
+        var = rng.uniform(low=self.var_range[0], high=self.var_range[1], size=num)
+        if xs is None:
+            xs = rng.uniform(low=self.input_range[0], high=self.input_range[1], size=(num, num_samples))
+            L = jittered_cholesky(gram_matrix(xs, variance=var[:, None, None]), jitter=self.jitter)
+            ys = np.matmul(L, rng.normal(size=(num, num_samples, 1)))[:, :, 0]
+        else:
+            xs = np.asarray(xs, dtype=np.float64)
+            eps = rng.normal(size=(num, xs.shape[0]))
+            ys = np.zeros_like(eps)
+            vs, inv = np.unique(var, return_inverse=True)
+            for k, v in enumerate(vs):
+                ys[inv==k] = np.dot(eps[inv==k], self._shared_cholesky(xs, v).T)
+            xs = np.broadcast_to(xs, (num, xs.shape[0]))
+        return xs, ys
+
+    def sample_rff(self, num, num_features=None, rng=None):
+        """
+        Sample functions from the random Fourier feature approximation of the
+        RBF prior, f(x) = sqrt(2/D) * sum_d w_d cos(omega_d x + b_d), with
+        omega_d ~ N(0, 1/variance), b_d ~ U(0, 2pi) and w_d ~ N(0, 1).
+        """
+        rng = get_rng(rng)
+        if num_features is None:
+            num_features = self.num_features
+        var = rng.uniform(low=self.var_range[0], high=self.var_range[1], size=num)
+        omegas = rng.normal(size=(num, num_features)) / np.sqrt(var)[:, None]
+        phases = rng.uniform(low=0., high=2*np.pi, size=(num, num_features))
+        weights = rng.normal(size=(num, num_features))
+        return [RFFunction(omegas[i], phases[i], weights[i], self.input_range, self.max_num_samples, self.input_sampling) for i in range(num)]
+
+    def _shared_cholesky(self, xs, variance, max_cache_size=64):
+        key = (xs.tobytes(), float(variance))
+        if key not in self._chol_cache:
+            if len(self._chol_cache) >= max_cache_size:
+                self._chol_cache.clear()
+            self._chol_cache[key] = jittered_cholesky(gram_matrix(xs, variance=variance), jitter=self.jitter)
+        return self._chol_cache[key]
 
     def _sample_function(self, num_samples):
-        xs = np.random.uniform(low=self.input_range[0], high=self.input_range[1], size=num_samples)
-        mean = [0 for x in xs]
-        var = np.random.uniform(low=self.var_range[0], high=self.var_range[1])
-        gram = gram_matrix(xs, variance=var)
-        ys = np.random.multivariate_normal(mean, gram)
-        return GPFunction(xs, ys)
+        return self.sample_functions(1, num_samples=num_samples)[0]
 
 
 def rbf_kernel(x1, x2, variance = 1):
     return np.exp(-1 * ((x1-x2) ** 2) / (2*variance))
 
 def gram_matrix(xs, variance=1):
-    return [[rbf_kernel(x1,x2, variance) for x2 in xs] for x1 in xs]
+    """
+    Gram matrix of the RBF kernel. xs has shape [..., n] and variance
+    broadcasts against the resulting [..., n, n] matrix.
+    """
+    xs = np.asarray(xs)
+    return rbf_kernel(xs[..., :, None], xs[..., None, :], variance)
+
+def jittered_cholesky(K, jitter=1e-6, max_tries=6):
+    """
+    Batched Cholesky factorization of K + jitter * I. The jitter is
+    increased tenfold until every matrix in the batch is positive definite.
+    """
+    eye = np.eye(K.shape[-1])
+    for _ in range(max_tries):
+        try:
+            return np.linalg.cholesky(K + jitter * eye)
+        except np.linalg.LinAlgError:
+            jitter *= 10
+    raise np.linalg.LinAlgError("Gram matrix is not positive definite, even with jitter {0}".format(jitter))
+
+def solve_lower(L, b):
+    """
+    Batched forward substitution: solve L x = b for lower triangular L of
+    shape [B, n, n] and b of shape [B, n, k], in O(n^2 k) per matrix.
+    """
+    x = np.empty(b.shape)
+    for i in range(L.shape[-1]):
+        x[:, i] = (b[:, i] - np.matmul(L[:, i:i+1, :i], x[:, :i])[:, 0]) / L[:, i, i, None]
+    return x
+
+
+class GPOracle(object):
+    """
+    Exact GP predictive distribution for tasks of a GPSample dataset with a
+    fixed kernel variance, used as an ideal baseline for evaluation.
+    Tasks are processed in batches of equal context/target sizes with batched
+    Cholesky solves. Factorizations are cached per context set, i.e. per
+    function and context size.
+    """
+    def __init__(self, variance, noise_var=1e-4, jitter=1e-6, max_cache_size=10000):
+        self.variance = variance
+        self.noise_var = noise_var
+        self.jitter = jitter
+        self.max_cache_size = max_cache_size
+        self._cache = {}
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        assert dataset.var_range[0]==dataset.var_range[1], "the oracle needs a fixed kernel variance"
+        return cls(dataset.var_range[0], **kwargs)
+
+    def _factorize(self, X_c):
+        keys = [x.tobytes() for x in X_c]
+        missing = [i for i, key in enumerate(keys) if key not in self._cache]
+        if len(missing) > 0:
+            if len(self._cache) + len(missing) > self.max_cache_size:
+                self._cache.clear()
+            K = gram_matrix(X_c[missing, :, 0], variance=self.variance) + self.noise_var * np.eye(X_c.shape[1])
+            for i, L in zip(missing, jittered_cholesky(K, jitter=self.jitter)):
+                self._cache[keys[i]] = L
+        return np.stack([self._cache[key] for key in keys])
+
+    def predict(self, X_c, y_c, X_t):
+        """
+        Args:
+          X_c, y_c: arrays of shape [B, n_c, 1] and [B, n_c].
+          X_t: array of shape [B, n_t, 1].
+        Returns:
+          Predictive means and variances of y_t, both of shape [B, n_t].
+        """
+        X_c, y_c, X_t = np.asarray(X_c, np.float64), np.asarray(y_c, np.float64), np.asarray(X_t, np.float64)
+        if X_c.shape[1] == 0:
+            return np.zeros(X_t.shape[:2]), np.ones(X_t.shape[:2]) + self.noise_var
+        L = self._factorize(X_c)
+        K_ct = rbf_kernel(X_c[:, :, :1], np.transpose(X_t, (0, 2, 1)), self.variance)
+        vw = solve_lower(L, np.concatenate([K_ct, y_c[:, :, None]], axis=2))
+        v, w = vw[:, :, :-1], vw[:, :, -1:]
+        mean = np.sum(v * w, axis=1)
+        var = 1. + self.noise_var - np.sum(v ** 2, axis=1)
+        return mean, np.maximum(var, self.noise_var)
+
+    def evaluate(self, X_c, y_c, X_t, y_t):
+        """
+        Returns:
+          Arrays of shape [B] with the mean squared error of the predictive
+          mean and the mean negative log-likelihood of the targets.
+        """
+        mean, var = self.predict(X_c, y_c, X_t)
+        sq_err = (np.asarray(y_t) - mean) ** 2
+        nll = 0.5 * np.log(2*np.pi*var) + sq_err / (2*var)
+        return np.mean(sq_err, axis=1), np.mean(nll, axis=1)
+
+
+def load_gpshards(data_dir, start=0, stop=None):
+    """
+    Memory-map the shards written by gen_gpsamples.py.
+    Returns:
+      A dict with 'xs' and 'ys' ShardedArrays over functions [start, stop) of
+      the concatenated shards. Nothing is read until a function is accessed,
+      and all processes share the pages through the page cache.
+    """
+    with open(os.path.join(data_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    data = {}
+    for key in ['xs', 'ys']:
+        arrays = [np.load(os.path.join(data_dir, shard[key]), mmap_mode='r') for shard in manifest['shards']]
+        data[key] = ShardedArray(arrays, start, stop)
+    return data
+
+
+class ShardedArray(object):
+    """
+    Read-only view of rows [start, stop) of a list of arrays concatenated
+    along the first axis. Supports integer indexing only.
+    """
+    def __init__(self, arrays, start=0, stop=None):
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [a.shape[0] for a in arrays])
+        if stop is None:
+            stop = int(self.offsets[-1])
+        assert 0 <= start <= stop <= self.offsets[-1], "rows [{0}, {1}) out of range".format(start, stop)
+        self.start = start
+        self.stop = stop
+        self.shape = (stop - start,) + arrays[0].shape[1:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("index {0} out of range".format(i))
+        i += self.start
+        k = np.searchsorted(self.offsets, i, side='right') - 1
+        return self.arrays[k][i - self.offsets[k]]
 
 
 class GPFunction(object):
 
-    def __init__(self, xs, ys):
+    def __init__(self, xs, ys, input_sampling="uniform"):
         assert len(xs)==len(ys), "len(xs)!=len(ys)"
+        if input_sampling not in ['uniform', 'stratified']:
+            raise Exception("stored GP functions support uniform or stratified input sampling, not {0}".format(input_sampling))
         self.xs = xs
         self.ys = ys
         self.num_samples = len(xs)
+        self.input_sampling = input_sampling
 
-    def sample(self, num_shots, test_shots):
+    def sample(self, num_shots, test_shots, rng=None):
         num_samples = num_shots + test_shots
         assert num_samples <= self.num_samples, "num_samples exceed max_num_samples"
-        p = np.random.choice(self.num_samples, size=(num_samples,), replace=False)
+        if self.input_sampling == 'uniform':
+            p = get_rng(rng).choice(self.num_samples, size=(num_samples,), replace=False)
+        else:
+            p = stratified_choice(self.xs, num_shots, test_shots, rng)
         xs, ys = self.xs[p][:,None], self.ys[p]
         return xs[:num_shots], ys[:num_shots], xs[num_shots:], ys[num_shots:]
 
+    def sample_points(self, num_samples, rng=None):
+        assert num_samples <= self.num_samples, "num_samples exceed max_num_samples"
+        p = get_rng(rng).choice(self.num_samples, size=(num_samples,), replace=False)
+        return self.xs[p][:,None], self.ys[p]
+
     def get_all_samples(self):
         return self.xs[:,None], self.ys
+
+
+class RFFunction(GPFunction):
+    """
+    A function drawn from the random Fourier feature approximation of a GP
+    prior. Points are evaluated lazily, so any number of context/target
+    points can be sampled at O(n*D) cost.
+    """
+    def __init__(self, omegas, phases, weights, input_range, num_samples=200, input_sampling="uniform"):
+        self.omegas = omegas
+        self.phases = phases
+        self.weights = weights * np.sqrt(2. / len(weights))
+        self.input_range = input_range
+        self.num_samples = num_samples
+        self.input_sampling = input_sampling
+
+    def query(self, xs, chunk_size=4096):
+        xs = np.asarray(xs)
+        ys = np.empty(xs.shape[0])
+        for i in range(0, xs.shape[0], chunk_size):
+            feats = np.cos(np.outer(xs[i:i+chunk_size], self.omegas) + self.phases)
+            ys[i:i+chunk_size] = np.dot(feats, self.weights)
+        return ys
+
+    def sample(self, num_shots, test_shots, rng=None):
+        xs = sample_inputs(self.input_range[0], self.input_range[1], num_shots, test_shots, self.input_sampling, rng)
+        ys = self.query(xs)
+        xs = xs[:,None]
+        return xs[:num_shots], ys[:num_shots], xs[num_shots:], ys[num_shots:]
+
+    def sample_points(self, num_samples, rng=None):
+        xs = get_rng(rng).uniform(low=self.input_range[0], high=self.input_range[1], size=num_samples)
+        return xs[:,None], self.query(xs)
+
+    def get_all_samples(self):
+        xs = np.linspace(self.input_range[0], self.input_range[1], num=self.num_samples)
+        return xs[:,None], self.query(xs)
@@ -0,0 +1,80 @@
+"""
+A bounded cache of decoded images shared by the image datasets of a
+process. Entries are evicted least recently used first once the byte
+budget is exceeded.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class ImageCache(object):
+
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """
+        Return the image cached under key, calling load() to decode it on a miss.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = load()
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self.num_bytes += value.nbytes
+                self._evict()
+        return value
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def _evict(self):
+        # the most recent entry is kept even if it alone exceeds the budget
+        while self.num_bytes > self.max_bytes and len(self._entries) > 1:
+            _, value = self._entries.popitem(last=False)
+            self.num_bytes -= value.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.,
+            "num_images": len(self._entries),
+            "num_bytes": self.num_bytes,
+        }
+
+    def __str__(self):
+        s = self.stats()
+        return "{0} hits, {1} misses ({2:0.1%} hit rate), {3} evictions, {4} images in {5:0.1f}MB".format(
+            s["hits"], s["misses"], s["hit_rate"], s["evictions"], s["num_images"], s["num_bytes"] / 2**20)
+
+
+_shared_cache = ImageCache()
+
+def shared_cache():
+    return _shared_cache
+
+def set_cache_budget(max_bytes):
+    _shared_cache.set_max_bytes(max_bytes)
@@ -1,20 +1,33 @@
+"""
+Registry of datasets. Loaders import their dataset module when called,
+so importing this module loads neither the datasets nor their
+dependencies. Loaded (train, val) pairs are cached per process.
+"""
+import os
 import numpy as np
 
 
+_loaders = {}
+_loaded = {}
+
+def register(dataset_name):
+    def decorator(loader):
+        _loaders[dataset_name] = loader
+        return loader
+    return decorator
+
 def load(dataset_name, **kwargs):
-    if dataset_name == 'gpsamples':
-        return load_gpsamples(**kwargs)
-    elif dataset_name == 'sinusoid':
-        return load_sinusoid(**kwargs)
-    elif dataset_name == 'omniglot':
-        return load_omniglot(**kwargs)
-    elif dataset_name == 'miniimagenet':
-        return load_miniimagenet(**kwargs)
-    elif dataset_name == 'celeba':
-        return load_celeba(**kwargs)
-    else:
+    if dataset_name not in _loaders:
         raise Exception("Dataset {0} not found".format(dataset_name))
+    key = (dataset_name, repr(sorted(kwargs.items())))
+    if key not in _loaded:
+        _loaded[key] = _loaders[dataset_name](**kwargs)
+    return _loaded[key]
+
+def clear_cache():
+    _loaded.clear()
 
+@register('celeba')
 def load_celeba():
     from data.celeba import CelebA
     data_dir = r"/data/ziz/not-backed-up/jxu/CelebA"
@@ -23,31 +36,56 @@ def load_celeba():
     return train_set, val_set
 
 
-def load_miniimagenet(num_classes=5):
+@register('miniimagenet')
+def load_miniimagenet(num_classes=5, packed_path="/data/ziz/not-backed-up/jxu/miniimagenet-packed"):
     from data.miniimagenet import Miniimagenet
+    from data.packed import packed_exists
     data_dir = r"/data/ziz/not-backed-up/jxu/miniimagenet"
-    train_set = Miniimagenet(data_dir, num_classes, 'train')
-    val_set = Miniimagenet(data_dir, num_classes, 'val')
+    if not packed_exists(packed_path):
+        packed_path = None
+    train_set = Miniimagenet(data_dir, num_classes, 'train', packed_path=packed_path)
+    val_set = Miniimagenet(data_dir, num_classes, 'val', packed_path=packed_path)
     return train_set, val_set
 
-def load_omniglot(num_classes=5):
+@register('omniglot')
+def load_omniglot(num_classes=5, packed_path="/data/ziz/not-backed-up/jxu/omniglot-packed"):
     import data.omniglot as og
-    train_set, val_set = og.load_omniglot("/data/ziz/not-backed-up/jxu/omniglot")
-    train_set = og.Omniglot(train_set, num_classes, dataset_name='omniglot-c{0}'.format(num_classes))
-    val_set = og.Omniglot(val_set, num_classes, dataset_name='omniglot-c{0}'.format(num_classes))
+    from data.packed import packed_exists
+    images = None
+    if packed_exists(packed_path):
+        images, train_set, val_set = og.load_packed_omniglot(packed_path)
+    else:
+        train_set, val_set = og.load_omniglot("/data/ziz/not-backed-up/jxu/omniglot")
+    train_set = og.Omniglot(train_set, num_classes, dataset_name='omniglot-c{0}'.format(num_classes), images=images)
+    val_set = og.Omniglot(val_set, num_classes, dataset_name='omniglot-c{0}'.format(num_classes), images=images)
     return train_set, val_set
 
-def load_sinusoid(amp_range=[0.1, 5.0], phase_range=[0, np.pi], period_range=[2*np.pi, 2*np.pi], input_range=[-5., 5.]):
+@register('sinusoid')
+def load_sinusoid(amp_range=[0.1, 5.0], phase_range=[0, np.pi], period_range=[2*np.pi, 2*np.pi], input_range=[-5., 5.], eval_input_sampling="uniform"):
     from data.sinusoid import Sinusoid
     train_set = Sinusoid(amp_range, phase_range, period_range, input_range, dataset_name="sinusoid")
-    val_set = train_set
+    val_set = Sinusoid(amp_range, phase_range, period_range, input_range, input_sampling=eval_input_sampling, dataset_name="sinusoid")
+    return train_set, val_set
+
+@register('timeseries')
+def load_timeseries(path="/data/ziz/not-backed-up/jxu/timeseries/series.f32", window=200, stride=1, val_fraction=0.1):
+    from data.timeseries import TimeSeries, open_series
+    series = open_series(path)
+    split = int(series.shape[0] * (1 - val_fraction))
+    train_set = TimeSeries(series, window, stride, start=0, stop=split)
+    val_set = TimeSeries(series, window, stride, start=split)
     return train_set, val_set
 
-def load_gpsamples():
-    from data.gpsample import GPSample
-    data = np.load("/data/ziz/not-backed-up/jxu/GPSamples/gpsamples_var05.npz")
-    train_data = {"xs":data['xs'][:50000], "ys":data['ys'][:50000]}
-    val_data = {"xs":data['xs'][50000:60000], "ys":data['ys'][50000:60000]}
+@register('gpsamples')
+def load_gpsamples(data_dir="/data/ziz/not-backed-up/jxu/GPSamples/var05", num_train=50000, num_val=10000, eval_input_sampling="uniform"):
+    from data.gpsample import GPSample, load_gpshards
+    if os.path.exists(os.path.join(data_dir, "manifest.json")):
+        train_data = load_gpshards(data_dir, 0, num_train)
+        val_data = load_gpshards(data_dir, num_train, num_train+num_val)
+    else:
+        data = np.load("/data/ziz/not-backed-up/jxu/GPSamples/gpsamples_var05.npz")
+        train_data = {"xs":data['xs'][:num_train], "ys":data['ys'][:num_train]}
+        val_data = {"xs":data['xs'][num_train:num_train+num_val], "ys":data['ys'][num_train:num_train+num_val]}
     train_set = GPSample(input_range=[-2., 2.], var_range=[0.5, 0.5], max_num_samples=200, data=train_data)
-    val_set = GPSample(input_range=[-2., 2.], var_range=[0.5, 0.5], max_num_samples=200, data=val_data)
+    val_set = GPSample(input_range=[-2., 2.], var_range=[0.5, 0.5], max_num_samples=200, data=val_data, input_sampling=eval_input_sampling)
     return train_set, val_set
@@ -12,28 +12,77 @@ import random
 
 from PIL import Image
 import numpy as np
-import tensorflow as tf
-import misc.helpers as helpers
+from misc.arrays import one_hot as to_one_hot
+from data.sampling import get_rng
+from data.packed import write_packed, read_packed
+from data.image_cache import shared_cache
 
 
 class Miniimagenet(object):
 
-    def __init__(self, data_dir, num_classes, which_set, dataset_name="miniimagenet"):
+    def __init__(self, data_dir, num_classes, which_set, dataset_name="miniimagenet", packed_path=None, one_hot=False):
+        """
+        If packed_path is given, episodes are drawn from the store written
+        by pack_miniimagenet instead of the image files in data_dir.
+        Labels are int32 class ids, or one-hot vectors if one_hot is set.
+        """
         self.data_dir = data_dir
         self.num_classes = num_classes
         self.which_set = which_set
         self.dataset_name = dataset_name
+        self.one_hot = one_hot
 
-        self.image_classes = read_dataset(self.data_dir, self.which_set)
+        if packed_path is None:
+            self.images = None
+            self.image_classes = read_dataset(self.data_dir, self.which_set)
+        else:
+            self.images, self.image_classes = load_packed_split(packed_path, self.which_set)
         self.num_image_classes = len(self.image_classes)
 
-    def sample(self, num):
+    def sample(self, num, rng=None):
+        rng = get_rng(rng)
         tasks = []
         for _ in range(num):
-            idx = np.random.choice(self.num_image_classes, size=self.num_classes).astype(np.int32)
-            tasks.append(ImageNetClasses([self.image_classes[i] for i in idx]))
+            idx = rng.choice(self.num_image_classes, size=self.num_classes).astype(np.int32)
+            if self.images is None:
+                tasks.append(ImageNetClasses([self.image_classes[i] for i in idx], one_hot=self.one_hot))
+            else:
+                tasks.append(PackedImageNetClasses(self.images, self.image_classes[idx], one_hot=self.one_hot))
         return tasks
 
+def read_packed_image(path):
+    with open(path, 'rb') as in_file:
+        return np.array(Image.open(in_file).resize((84, 84)).convert('RGB'))
+
+def pack_miniimagenet(data_dir, path, processes=None):
+    """
+    Decode the train, val and test splits into one uint8 array of shape
+    [N, 84, 84, 3] (see data.packed). The index maps every split to its
+    WNIDs and the [start, stop) range of each class in the array.
+    """
+    filenames = []
+    index = {"splits": {}}
+    for which_set in ['train', 'val', 'test']:
+        set_dir = os.path.join(data_dir, which_set)
+        wnids = sorted(f for f in os.listdir(set_dir) if f.startswith('n'))
+        ranges = []
+        for wnid in wnids:
+            class_dir = os.path.join(set_dir, wnid)
+            names = sorted(f for f in os.listdir(class_dir) if f.endswith('.jpg'))
+            ranges.append([len(filenames), len(filenames)+len(names)])
+            filenames += [os.path.join(class_dir, name) for name in names]
+        index["splits"][which_set] = {"classes": wnids, "ranges": ranges}
+    write_packed(path, filenames, (84, 84, 3), read_packed_image, index, processes=processes)
+
+def load_packed_split(path, which_set):
+    """
+    Returns:
+      A tuple (images, ranges), images being the uint8 memmap of the whole
+      store and ranges an int array of [start, stop) pairs, one per class.
+    """
+    images, index = read_packed(path)
+    return images, np.array(index["splits"][which_set]["ranges"], dtype=np.int64)
+
 def read_dataset(data_dir, which_set=None):
 
     if which_set is None:
@@ -51,58 +100,88 @@ def _read_classes(dir_path):
 
 class ImageNetClasses:
 
-    def __init__(self, image_classes, one_hot=True):
+    def __init__(self, image_classes, one_hot=False):
         self.image_classes = image_classes
         self.num_image_classes = len(image_classes)
         self.one_hot = one_hot
 
-    def sample(self, num_shots, test_shots):
+    def sample(self, num_shots, test_shots, rng=None):
         total_shots = num_shots + test_shots
         assert total_shots <= 20, "num_shots+test_shots={0}, but only have 20 instances in each class".format(total_shots)
         xs_train, xs_test = [], []
         ys_train, ys_test = [], []
         for i, c in enumerate(self.image_classes):
-            s = c.sample(total_shots)
+            s = c.sample(total_shots, rng)
             xs_train.append(s[:num_shots])
             xs_test.append(s[num_shots:])
             ys_train.append(np.ones(num_shots)*i)
             ys_test.append(np.ones(test_shots)*i)
         xs_train = np.concatenate(xs_train, axis=0)
         xs_test = np.concatenate(xs_test, axis=0)
-        ys_train = np.concatenate(ys_train, axis=0)
-        ys_test = np.concatenate(ys_test, axis=0)
+        ys_train = np.concatenate(ys_train, axis=0).astype(np.int32)
+        ys_test = np.concatenate(ys_test, axis=0).astype(np.int32)
         if self.one_hot:
-            ys_train = helpers.one_hot(ys_train, self.num_image_classes)
-            ys_test = helpers.one_hot(ys_test, self.num_image_classes)
+            ys_train = to_one_hot(ys_train, self.num_image_classes)
+            ys_test = to_one_hot(ys_test, self.num_image_classes)
+        return xs_train, ys_train, xs_test, ys_test
+
+class PackedImageNetClasses:
+    """
+    N-way classes backed by a packed store, given as [start, stop) ranges.
+    """
+
+    def __init__(self, images, ranges, one_hot=False):
+        self.images = images
+        self.ranges = ranges
+        self.num_image_classes = len(ranges)
+        self.one_hot = one_hot
+
+    def sample(self, num_shots, test_shots, rng=None):
+        rng = get_rng(rng)
+        total_shots = num_shots + test_shots
+        sizes = self.ranges[:, 1] - self.ranges[:, 0]
+        assert total_shots <= sizes.min(), "num_shots+test_shots={0}, but only have {1} instances in some class".format(total_shots, sizes.min())
+        idx = np.stack([start + rng.choice(size, size=total_shots, replace=False) for start, size in zip(self.ranges[:, 0], sizes)])
+        imgs = self.images[idx.reshape(-1)].reshape(idx.shape + self.images.shape[1:])
+        xs_train = imgs[:, :num_shots].reshape((-1,)+imgs.shape[2:])
+        xs_test = imgs[:, num_shots:].reshape((-1,)+imgs.shape[2:])
+        ys_train = np.repeat(np.arange(self.num_image_classes, dtype=np.int32), num_shots)
+        ys_test = np.repeat(np.arange(self.num_image_classes, dtype=np.int32), test_shots)
+        if self.one_hot:
+            ys_train = to_one_hot(ys_train, self.num_image_classes)
+            ys_test = to_one_hot(ys_test, self.num_image_classes)
         return xs_train, ys_train, xs_test, ys_test
 
 # pylint: disable=R0903
 class ImageNetClass:
     """
-    A single image class.
+    A single image class. Decoded images are kept in an ImageCache (the
+    shared one by default).
     """
-    def __init__(self, dir_path):
+    def __init__(self, dir_path, cache=None):
         self.dir_path = dir_path
-        self._cache = {}
+        self._cache = shared_cache() if cache is None else cache
 
-    def sample(self, num_images):
+    def sample(self, num_images, rng=None):
         """
-        Sample images (as numpy arrays) from the class.
+        Sample images (as numpy arrays) from the class, drawing from rng
+        if given.
         Returns:
-          A sequence of 84x84x3 numpy arrays.
-          Each pixel ranges from 0 to 1.
+          A sequence of 84x84x3 uint8 numpy arrays.
+          Models scale them to [0, 1] in the graph.
         """
         names = [f for f in os.listdir(self.dir_path) if f.endswith('.jpg')] # JPEG
-        random.shuffle(names)
+        get_rng(rng).shuffle(names)
         images = []
         for name in names[:num_images]:
             images.append(self._read_image(name))
         return images
 
     def _read_image(self, name):
-        if name in self._cache:
-            return self._cache[name].astype('float32') / 0xff
-        with open(os.path.join(self.dir_path, name), 'rb') as in_file:
+        path = os.path.join(self.dir_path, name)
+        return self._cache.get(path, lambda: self._decode(path))
+
+    def _decode(self, path):
+        with open(path, 'rb') as in_file:
             img = Image.open(in_file).resize((84, 84)).convert('RGB')
-            self._cache[name] = np.array(img)
-            return self._read_image(name)
+            return np.array(img)
@@ -10,8 +10,10 @@ import random
 
 from PIL import Image
 import numpy as np
-import tensorflow as tf
-import misc.helpers as helpers
+from misc.arrays import one_hot as to_one_hot
+from data.sampling import get_rng
+from data.packed import write_packed, read_packed
+from data.image_cache import shared_cache
 
 def load_omniglot(data_dir, num_train=1200, augment_train_set=True):
     data = read_dataset(data_dir)
@@ -20,20 +22,71 @@ def load_omniglot(data_dir, num_train=1200, augment_train_set=True):
     eval_set = list(eval_set)
     return train_set, eval_set
 
+def load_packed_omniglot(path, num_train=1200, augment_train_set=True):
+    """
+    Load a store written by pack_omniglot and split it like load_omniglot.
+    Returns:
+      A tuple (images, train_set, eval_set). images is a uint8 memmap of
+      shape [num_chars, 20, 28, 28], the sets are int arrays of
+      (character index, number of 90 degree rotations) pairs.
+    """
+    images, index = read_packed(path)
+    images = images.reshape((len(index['characters']), index['num_drawings'])+images.shape[1:])
+    chars = list(range(images.shape[0]))
+    random.shuffle(chars)
+    train_chars, eval_chars = chars[:num_train], chars[num_train:]
+    rotations = [0, 1, 2, 3] if augment_train_set else [0]
+    train_set = np.array([(c, k) for c in train_chars for k in rotations], dtype=np.int32)
+    eval_set = np.array([(c, 0) for c in eval_chars], dtype=np.int32)
+    return images, train_set, eval_set
+
+def read_packed_image(path):
+    with open(path, 'rb') as in_file:
+        return np.array(Image.open(in_file).resize((28, 28))).astype(np.uint8)
+
+def pack_omniglot(data_dir, path, processes=None):
+    """
+    Decode every drawing once into a uint8 array of shape
+    [num_chars * 20, 28, 28] (see data.packed), characters in the order of
+    read_dataset and drawings sorted by filename.
+    """
+    char_dirs = [char.dir_path for char in read_dataset(data_dir)]
+    filenames = []
+    for char_dir in char_dirs:
+        names = sorted(f for f in os.listdir(char_dir) if f.endswith('.png'))
+        assert len(names) == 20, "{0} has {1} drawings, expected 20".format(char_dir, len(names))
+        filenames += [os.path.join(char_dir, name) for name in names]
+    index = {
+        "characters": [os.path.relpath(d, data_dir) for d in char_dirs],
+        "num_drawings": 20,
+    }
+    write_packed(path, filenames, (28, 28), read_packed_image, index, processes=processes)
+
 
 class Omniglot(object):
 
-    def __init__(self, chars, num_classes, dataset_name="omniglot"):
+    def __init__(self, chars, num_classes, dataset_name="omniglot", images=None, one_hot=False):
+        """
+        chars is a list of Characters or, together with the images of a
+        packed store, an array of (character index, rotation) pairs.
+        Labels are int32 class ids, or one-hot vectors if one_hot is set.
+        """
         self.dataset_name = dataset_name
         self.chars = chars
         self.num_char = len(chars)
         self.num_classes = num_classes
+        self.images = images
+        self.one_hot = one_hot
 
-    def sample(self, num):
+    def sample(self, num, rng=None):
+        rng = get_rng(rng)
         tasks = []
         for _ in range(num):
-            idx = np.random.choice(self.num_char, size=self.num_classes).astype(np.int32)
-            tasks.append(Characters([self.chars[i] for i in idx]))
+            idx = rng.choice(self.num_char, size=self.num_classes).astype(np.int32)
+            if self.images is None:
+                tasks.append(Characters([self.chars[i] for i in idx], one_hot=self.one_hot))
+            else:
+                tasks.append(PackedCharacters(self.images, self.chars[idx], one_hot=self.one_hot))
         return tasks
 
 
@@ -78,22 +131,22 @@ def augment_dataset(dataset):
     """
     for character in dataset:
         for rotation in [0, 90, 180, 270]:
-            yield Character(character.dir_path, rotation=rotation)
+            yield Character(character.dir_path, rotation=rotation, cache=character._cache)
 
 class Characters:
 
-    def __init__(self, chars, one_hot=True):
+    def __init__(self, chars, one_hot=False):
         self.chars = chars
         self.num_char = len(chars)
         self.one_hot = one_hot
 
-    def sample(self, num_shots, test_shots, shuffle=True):
+    def sample(self, num_shots, test_shots, shuffle=True, rng=None):
         total_shots = num_shots + test_shots
         assert total_shots <= 20, "num_shots+test_shots={0}, but only have 20 instances in each class".format(total_shots)
         xs_train, xs_test = [], []
         ys_train, ys_test = [], []
         for i, char in enumerate(self.chars):
-            s = char.sample(total_shots)
+            s = char.sample(total_shots, rng)
             xs_train.append(s[:num_shots])
             xs_test.append(s[num_shots:])
             ys_train.append(np.ones(num_shots)*i)
@@ -102,45 +155,94 @@ class Characters:
         xs_test = np.concatenate(xs_test, axis=0)
         ys_train = np.concatenate(ys_train, axis=0)
         ys_test = np.concatenate(ys_test, axis=0)
-        if self.one_hot:
-            ys_train = helpers.one_hot(ys_train, self.num_char)
-            ys_test = helpers.one_hot(ys_test, self.num_char)
-        if shuffle:
-            p = np.random.permutation(xs_train.shape[0])
-            xs_train, ys_train = xs_train[p], ys_train[p]
-            p = np.random.permutation(xs_test.shape[0])
-            xs_test, ys_test = xs_test[p], ys_test[p]
-        return xs_train, ys_train, xs_test, ys_test
+        return _make_episode(xs_train, ys_train, xs_test, ys_test, self.num_char, self.one_hot, shuffle, rng)
+
+
+class PackedCharacters:
+    """
+    N-way classes backed by a packed store. Episodes are built by fancy
+    indexing into the images, no file is read per episode.
+    """
+
+    def __init__(self, images, classes, one_hot=False):
+        self.images = images
+        self.classes = classes
+        self.num_char = len(classes)
+        self.one_hot = one_hot
+
+    def sample(self, num_shots, test_shots, shuffle=True, rng=None):
+        drawings = self.sample_drawings(num_shots + test_shots, rng)
+        imgs = self.images[self.classes[:, 0][:, None], drawings]
+        for k in np.unique(self.classes[:, 1]):
+            if k != 0:
+                rotated = self.classes[:, 1] == k
+                imgs[rotated] = np.rot90(imgs[rotated], k, axes=(2, 3))
+        imgs = imgs[..., None]
+        xs_train = imgs[:, :num_shots].reshape((-1,)+imgs.shape[2:])
+        xs_test = imgs[:, num_shots:].reshape((-1,)+imgs.shape[2:])
+        ys_train = np.repeat(np.arange(self.num_char), num_shots)
+        ys_test = np.repeat(np.arange(self.num_char), test_shots)
+        return _make_episode(xs_train, ys_train, xs_test, ys_test, self.num_char, self.one_hot, shuffle, rng)
+
+
+    def sample_drawings(self, total_shots, rng=None):
+        """
+        Independent drawings without replacement for every class, as an
+        int32 array of shape [num_classes, total_shots].
+        """
+        num_drawings = self.images.shape[1]
+        assert total_shots <= num_drawings, "num_shots+test_shots={0}, but only have {1} instances in each class".format(total_shots, num_drawings)
+        return np.argsort(get_rng(rng).uniform(size=(self.num_char, num_drawings)), axis=1)[:, :total_shots].astype(np.int32)
+
+
+def _make_episode(xs_train, ys_train, xs_test, ys_test, num_char, one_hot, shuffle, rng=None):
+    ys_train, ys_test = ys_train.astype(np.int32), ys_test.astype(np.int32)
+    if one_hot:
+        ys_train = to_one_hot(ys_train, num_char)
+        ys_test = to_one_hot(ys_test, num_char)
+    if shuffle:
+        rng = get_rng(rng)
+        p = rng.permutation(xs_train.shape[0])
+        xs_train, ys_train = xs_train[p], ys_train[p]
+        p = rng.permutation(xs_test.shape[0])
+        xs_test, ys_test = xs_test[p], ys_test[p]
+    return xs_train, ys_train, xs_test, ys_test
 
 
 
 class Character:
     """
-    A single character class.
+    A single character class. Decoded images live unrotated in an
+    ImageCache (the shared one by default), so rotations of the same
+    character share them and rotating returns a view.
     """
-    def __init__(self, dir_path, rotation=0):
+    def __init__(self, dir_path, rotation=0, cache=None):
+        assert rotation % 90 == 0, "rotation must be a multiple of 90 degrees"
         self.dir_path = dir_path
         self.rotation = rotation
-        self._cache = {}
+        self._cache = shared_cache() if cache is None else cache
 
-    def sample(self, num_images):
+    def sample(self, num_images, rng=None):
         """
-        Sample images (as numpy arrays) from the class.
+        Sample images (as numpy arrays) from the class, drawing from rng
+        if given.
         Returns:
-          A sequence of 28x28 numpy arrays.
-          Each pixel ranges from 0 to 1.
+          A sequence of 28x28x1 uint8 numpy arrays.
+          Each pixel is 0 or 1.
         """
         names = [f for f in os.listdir(self.dir_path) if f.endswith('.png')]
-        random.shuffle(names)
+        get_rng(rng).shuffle(names)
         images = []
         for name in names[:num_images]:
             images.append(self._read_image(os.path.join(self.dir_path, name)))
         return images
 
     def _read_image(self, path):
-        if path in self._cache:
-            return self._cache[path]
+        img = self._cache.get(path, lambda: self._decode(path))
+        # PIL rotates counter-clockwise, as does np.rot90
+        return np.rot90(img, self.rotation // 90)
+
+    def _decode(self, path):
         with open(path, 'rb') as in_file:
-            img = Image.open(in_file).resize((28, 28)).rotate(self.rotation)
-            self._cache[path] = np.array(img).astype('float32')[:, :, None]
-            return self._cache[path]
+            img = Image.open(in_file).resize((28, 28))
+            return np.array(img).astype(np.uint8)[:, :, None]
@@ -0,0 +1,47 @@
+"""
+Packed image stores. All images of a dataset are decoded once into a
+single uint8 .npy file, which is memory-mapped when read (so processes
+share it through the page cache), together with a JSON index.
+"""
+
+import os
+import json
+from multiprocessing import Pool
+import numpy as np
+
+
+def packed_exists(path):
+    return os.path.exists(path + ".npy") and os.path.exists(path + ".json")
+
+
+def write_packed(path, filenames, shape, read_image, index, processes=1, chunksize=64):
+    """
+    Decode images into path.npy and write index to path.json.
+    Args:
+      filenames: list of image files, in the order they are stored.
+      shape: shape of a decoded image.
+      read_image: picklable function mapping a filename to a uint8 array of that shape.
+      index: JSON-serializable description of the layout.
+      processes: number of decoding processes (None for all cores).
+    """
+    tmp_path = path + ".tmp.npy"
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(filenames),)+tuple(shape))
+    with Pool(processes) as pool:
+        for i, img in enumerate(pool.imap(read_image, filenames, chunksize)):
+            images[i] = img
+    images.flush()
+    del images
+    os.rename(tmp_path, path + ".npy")
+    with open(path + ".json", 'w') as f:
+        json.dump(index, f)
+
+
+def read_packed(path):
+    """
+    Returns:
+      A tuple (images, index), images being a read-only memmap.
+    """
+    images = np.load(path + ".npy", mmap_mode='r')
+    with open(path + ".json") as f:
+        index = json.load(f)
+    return images, index
@@ -0,0 +1,211 @@
+import random
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+
+class EpochPermutation(object):
+    """
+    Draw indices from range(n) without replacement, going through one random
+    permutation per epoch. A call costs O(num) instead of the O(n) of
+    np.random.choice(n, num, replace=False).
+
+    With the stream of item i (see item_rng), the indices only depend on
+    the seed and i, not on what was drawn before (e.g. by other workers):
+    item i takes the i-th block of num indices of the same sequence of
+    epochs, epoch e being a permutation drawn from item_rng(seed, e)'s own
+    child stream. Other explicit streams draw with rng.choice.
+
+    Calls are serialized by a lock, so producer threads sharing a dataset
+    never get the same indices.
+    """
+    def __init__(self, n):
+        self.n = n
+        self._perm = np.random.permutation(self.n)
+        self._pos = 0
+        self._lock = threading.Lock()
+        # (seed, epoch) and permutation of the last epoch of item streams
+        self._item_epoch = None, None
+
+    def next(self, num, rng=None):
+        assert num <= self.n, "cannot draw {0} indices out of {1}".format(num, self.n)
+        if isinstance(rng, ItemRNG):
+            return self._item_indices(num, rng.seed, rng.index)
+        if rng is not None:
+            return rng.choice(self.n, size=num, replace=False)
+        with self._lock:
+            if self._pos + num > self.n:
+                self._perm = np.random.permutation(self.n)
+                self._pos = 0
+            idx = self._perm[self._pos:self._pos+num]
+            self._pos += num
+            return idx
+
+    def reset(self):
+        with self._lock:
+            self._perm = np.random.permutation(self.n)
+            self._pos = 0
+
+    def _item_indices(self, num, seed, index):
+        # as without a stream, the last n % num indices of an epoch are skipped
+        epoch, k = divmod(index, self.n // num)
+        with self._lock:
+            key, perm = self._item_epoch
+            if key != (seed, epoch):
+                # a child of item epoch's stream, so that it does not repeat that item's draws
+                perm = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(epoch, 0))).permutation(self.n)
+                self._item_epoch = (seed, epoch), perm
+        return perm[k*num:(k+1)*num]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def get_rng(rng=None):
+    """
+    The random stream to draw from: rng if given, otherwise the global numpy
+    RNG. rng is an np.random.Generator (or RandomState, or ItemRNG); samplers
+    only call the methods both have in common with np.random (uniform,
+    normal, permutation, choice, shuffle).
+    """
+    return np.random if rng is None else rng
+
+
+class ItemRNG(object):
+    """
+    np.random.Generator of the index-th item produced from seed, see
+    item_rng. Draws are forwarded to the generator; seed and index let
+    samplers keep state across items, e.g. EpochPermutation.
+    """
+    def __init__(self, seed, index):
+        self.seed = seed
+        self.index = index
+        self.generator = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(index,)))
+
+    def __getattr__(self, name):
+        if name == 'generator':
+            raise AttributeError(name)
+        return getattr(self.generator, name)
+
+
+def item_rng(seed, index):
+    """
+    Generator of the index-th item (e.g. meta-batch or episode) produced
+    from seed, i.e. of the index-th child of SeedSequence(seed). A producer
+    drawing item i from item_rng(seed, i) yields the same sequence however
+    many workers share the items.
+    """
+    return ItemRNG(seed, index)
+
+
+class ShotRange(object):
+    """
+    Number of shots drawn uniformly from [low, high), from rng if given.
+    Replaces partial(np.random.randint, low=low, high=high), which cannot
+    draw from an explicit stream.
+    """
+    def __init__(self, low, high):
+        assert low < high, "empty shot range [{0}, {1})".format(low, high)
+        self.low = low
+        self.high = high
+
+    def __call__(self, rng=None):
+        return self.low + int(get_rng(rng).choice(self.high - self.low))
+
+    def __repr__(self):
+        return "ShotRange({0}, {1})".format(self.low, self.high)
+
+
+def draw_shots(gen, rng=None):
+    """
+    Call a num_shots generator, passing rng if given. Generators used with
+    explicit streams have to accept one (see ShotRange).
+    """
+    return gen() if rng is None else gen(rng)
+
+
+@contextmanager
+def fixed_seed(seed):
+    """
+    Run a block with the global numpy and python RNGs seeded with seed,
+    restoring their previous states afterwards. Evaluating under the same
+    seed gives common random numbers across checkpoints and models.
+    """
+    np_state, py_state = np.random.get_state(), random.getstate()
+    np.random.seed(seed)
+    random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(np_state)
+        random.setstate(py_state)
+
+
+def van_der_corput(n, base=2):
+    """
+    First n points of the van der Corput sequence (the 1d Sobol sequence).
+    """
+    i = np.arange(n)
+    u = np.zeros(n)
+    f = 1. / base
+    while np.any(i > 0):
+        u += f * (i % base)
+        i //= base
+        f /= base
+    return u
+
+
+def stratified_uniform(n, rng=None):
+    """
+    One uniform draw in each of n equal-width strata of [0, 1), in random order.
+    """
+    rng = get_rng(rng)
+    return (rng.permutation(n) + rng.uniform(size=n)) / n
+
+
+def sample_inputs(low, high, num_shots, test_shots, method="uniform", rng=None):
+    """
+    Draw num_shots context and test_shots target input locations in [low, high).
+    Args:
+      method: 'uniform' for i.i.d. draws, 'stratified' to stratify context and
+        target sets separately, or 'sobol' for a randomly shifted van der
+        Corput sequence, whose context prefix is itself evenly spread.
+      rng: random stream, the global numpy RNG by default.
+    Returns:
+      An array of shape [num_shots+test_shots], context points first.
+    """
+    rng = get_rng(rng)
+    if method == 'uniform':
+        u = rng.uniform(size=num_shots+test_shots)
+    elif method == 'stratified':
+        u = np.concatenate([stratified_uniform(num_shots, rng), stratified_uniform(test_shots, rng)])
+    elif method == 'sobol':
+        u = (van_der_corput(num_shots+test_shots) + rng.uniform()) % 1.
+    else:
+        raise Exception("unknown input sampling method {0}".format(method))
+    return low + (high - low) * u
+
+
+def _one_per_stratum(idx, n, rng):
+    if n == 0:
+        return np.zeros((0,), dtype=np.int64)
+    return np.array([rng.choice(s) for s in np.array_split(idx, n)], dtype=np.int64)
+
+
+def stratified_choice(xs, num_shots, test_shots, rng=None):
+    """
+    Choose num_shots context and then test_shots target indices among the
+    stored input locations xs, one index in each stratum of the sorted
+    locations.
+    """
+    rng = get_rng(rng)
+    order = np.argsort(xs)
+    c_idx = _one_per_stratum(order, num_shots, rng)
+    t_idx = _one_per_stratum(order[~np.isin(order, c_idx)], test_shots, rng)
+    return np.concatenate([c_idx, t_idx])
@@ -1,36 +1,65 @@
 import os
 import random
 import numpy as np
+from data.sampling import get_rng, sample_inputs
 
 
 class Sinusoid(object):
 
-    def __init__(self, amp_range, phase_range, period_range=[2*np.pi, 2*np.pi], input_range=[-5, 5], dataset_name="sinusoid"):
+    # sample_batch draws whole meta-batches as padded arrays, see MetaLearner
+    batched_sampling = True
+
+    def __init__(self, amp_range, phase_range, period_range=[2*np.pi, 2*np.pi], input_range=[-5, 5], input_sampling="uniform", dataset_name="sinusoid"):
         self.dataset_name = dataset_name
+        self.input_sampling = input_sampling
         self.amp_range = amp_range
         self.phase_range = phase_range
         self.period_range = period_range
         self.input_range = input_range
 
-    def sample(self, num):
-        sines = []
-        for i in range(num):
-            amp = np.random.uniform(self.amp_range[0], self.amp_range[1])
-            phase = np.random.uniform(self.phase_range[0], self.phase_range[1])
-            period = np.random.uniform(self.period_range[0], self.period_range[1])
-            sines.append(SineWave(amp, phase, period, self.input_range))
-        return sines
+    def sample(self, num, rng=None):
+        amps, phases, periods = self._sample_params(num, rng)
+        return [SineWave(amp, phase, period, self.input_range, self.input_sampling) for amp, phase, period in zip(amps, phases, periods)]
+
+    def sample_batch(self, num, num_shots, test_shots, rng=None):
+        """
+        Sample a whole meta-batch of sine wave tasks with a few vectorized calls.
+        Args:
+          num: number of tasks B.
+          num_shots, test_shots: ints, or sequences of length B with per-task counts.
+        Returns:
+          A tuple (xs, ys, num_shots, test_shots). xs and ys are float32 arrays
+          of shape [B, N, 1], N being the largest num_shots+test_shots in the batch.
+          Task i uses the first num_shots[i] points as context and the next
+          test_shots[i] points as target. num_shots and test_shots are returned
+          as int32 arrays of length B.
+        """
+        num_shots = np.broadcast_to(np.asarray(num_shots, dtype=np.int32), (num,))
+        test_shots = np.broadcast_to(np.asarray(test_shots, dtype=np.int32), (num,))
+        num_samples = int(np.max(num_shots + test_shots))
+        amps, phases, periods = self._sample_params(num, rng)
+        xs = get_rng(rng).uniform(self.input_range[0], self.input_range[1], size=(num, num_samples, 1)).astype(np.float32)
+        ys = amps[:, None, None] * np.sin( 2*np.pi*(xs - phases[:, None, None]) / periods[:, None, None] )
+        return xs, ys.astype(np.float32), num_shots, test_shots
+
+    def _sample_params(self, num, rng=None):
+        rng = get_rng(rng)
+        amps = rng.uniform(self.amp_range[0], self.amp_range[1], size=num)
+        phases = rng.uniform(self.phase_range[0], self.phase_range[1], size=num)
+        periods = rng.uniform(self.period_range[0], self.period_range[1], size=num)
+        return amps, phases, periods
 
 
 class SineWave(object):
     """
     A single sine wave class.
     """
-    def __init__(self, amp, phase, period, input_range):
+    def __init__(self, amp, phase, period, input_range, input_sampling="uniform"):
         self.amp = amp
         self.phase = phase
         self.period = period
         self.input_range = input_range
+        self.input_sampling = input_sampling
         # self.tags = {"amp":amp, "phase":phase, "input_range":input_range}
 
     def query(self, X):
@@ -44,16 +73,20 @@ class SineWave(object):
     #     np.random.shuffle(samples)
     #     return samples
 
-    def sample(self, num_shots, test_shots, xs=None):
+    def sample(self, num_shots, test_shots, xs=None, rng=None):
         num_samples = num_shots + test_shots
         if xs is None:
-            xs = np.random.uniform(self.input_range[0], self.input_range[1], [num_samples,1])
+            xs = sample_inputs(self.input_range[0], self.input_range[1], num_shots, test_shots, self.input_sampling, rng)[:, None]
         ys = self.amp * np.sin( 2*np.pi*(xs[:, 0] - self.phase) / self.period )
         if xs is None:
-            p = np.random.permutation(num_samples)
+            p = get_rng(rng).permutation(num_samples)
             xs = xs[p]
             ys = ys[p]
         return xs[:num_shots], ys[:num_shots], xs[num_shots:], ys[num_shots:]
 
+    def sample_points(self, num_samples, rng=None):
+        xs = get_rng(rng).uniform(self.input_range[0], self.input_range[1], [num_samples,1])
+        return xs, self.query(xs)[:, 0]
+
     def get_all_samples(self):
         return self.sample(200, 0)[:2]
@@ -0,0 +1,49 @@
+"""
+Regression tasks cut from a long univariate time series.
+The series is a flat float32 file, either raw (e.g. .f32/.bin) or .npy,
+memory-mapped so that only the windows in flight are read.
+"""
+
+import numpy as np
+from data.gpsample import GPFunction
+from data.sampling import EpochPermutation
+
+
+def open_series(path):
+    if path.endswith('.npy'):
+        series = np.load(path, mmap_mode='r')
+    else:
+        series = np.memmap(path, dtype=np.float32, mode='r')
+    assert series.dtype == np.float32, "expect a float32 series, got {0}".format(series.dtype)
+    return series.reshape(-1)
+
+
+class TimeSeries(object):
+
+    def __init__(self, series, window, stride=1, start=0, stop=None, input_range=[0., 1.], dataset_name="timeseries"):
+        """
+        Args:
+          series: 1d array (typically a memmap, see open_series).
+          window: number of time steps per task.
+          stride: step between consecutive window starts.
+          start, stop: range of the series to cut windows from.
+          input_range: time steps of a window are mapped to evenly spaced inputs in this range.
+        """
+        self.dataset_name = dataset_name
+        self.series = series[start:stop]
+        self.window = window
+        self.stride = stride
+        self.input_range = input_range
+        self.num_windows = (self.series.shape[0] - window) // stride + 1
+        assert self.num_windows > 0, "series is shorter than one window"
+        step = self.series.strides[0]
+        # zero-copy view of all windows, shape [num_windows, window]
+        self.windows = np.lib.stride_tricks.as_strided(self.series, shape=(self.num_windows, window), strides=(stride*step, step), writeable=False)
+        self.xs = np.linspace(input_range[0], input_range[1], num=window, endpoint=False).astype(np.float32)
+        self._perm = EpochPermutation(self.num_windows)
+
+    def sample(self, num, rng=None):
+        return [GPFunction(self.xs, self.windows[i]) for i in self._perm.next(num, rng)]
+
+    def reset(self):
+        self._perm.reset()
@@ -0,0 +1,39 @@
+"""
+Write padded training episodes of a dataset to a TFRecord file, to be read
+by the tfdata input pipeline (--input_pipeline tfdata --episode_records).
+Episode i is drawn from its own stream of --seed, so files of disjoint
+--first_episode ranges can be written in parallel.
+
+    python gen_episodes.py --dataset_name sinusoid --output /data/ziz/not-backed-up/jxu/episodes/sinusoid-00000.tfrecord --num_episodes 100000
+"""
+import argparse
+import time
+import numpy as np
+from data.load_data import load
+from misc.episodes import write_episode_records
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--dataset_name', help='name of dataset', default='sinusoid')
+    parser.add_argument('--output', help='TFRecord file to write', required=True)
+    parser.add_argument('--num_episodes', help='number of episodes', default=100000, type=int)
+    parser.add_argument('--num_shots', help='range [low, high) of context sizes', default=[1, 20], nargs=2, type=int)
+    parser.add_argument('--test_shots', help='range [low, high) of target sizes', default=[1, 20], nargs=2, type=int)
+    parser.add_argument('--obs_shape', help='shape of an input point', default=[1], nargs='+', type=int)
+    parser.add_argument('--first_episode', help='index of the first episode written', default=0, type=int)
+    parser.add_argument('--seed', help='random seed', default=0, type=int)
+    return parser
+
+
+def main(args):
+    np.random.seed(args.seed)
+    train_set, _ = load(dataset_name=args.dataset_name)
+    start_time = time.time()
+    write_episode_records(train_set, args.output, args.num_episodes, tuple(args.num_shots), tuple(args.test_shots), args.obs_shape,
+                          seed=args.seed, first_episode=args.first_episode)
+    print("wrote {0} episodes to {1} ({2:0.1f}s)".format(args.num_episodes, args.output, time.time()-start_time))
+
+
+if __name__ == '__main__':
+    main(argument_parser().parse_args())
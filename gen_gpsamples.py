@@ -0,0 +1,99 @@
+"""
+Generate GP function samples as fixed-size float32 shards.
+
+    python gen_gpsamples.py --output_dir /data/ziz/not-backed-up/jxu/GPSamples/var05 --num_functions 60000
+
+Every shard is a pair of .npy files, xs of shape [shard_size, num_samples, 1]
+and ys of shape [shard_size, num_samples] (the layout of gpsamples_var05.npz).
+manifest.json lists the shards in order, with the seed, spawn key and kernel
+parameters used to generate each of them: shard i draws from the i-th child
+of SeedSequence(seed) (data.sampling.item_rng), so runs with different seeds
+share no shard.
+"""
+import os
+import json
+import argparse
+import time
+from multiprocessing import Pool
+import numpy as np
+from data.gpsample import GPSample
+from data.sampling import item_rng
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--output_dir', help='directory to write shards and manifest to', required=True)
+    parser.add_argument('--num_functions', help='total number of functions', default=60000, type=int)
+    parser.add_argument('--shard_size', help='number of functions per shard', default=10000, type=int)
+    parser.add_argument('--num_samples', help='number of input locations per function', default=200, type=int)
+    parser.add_argument('--input_range', help='range of input locations', default=[-2., 2.], nargs=2, type=float)
+    parser.add_argument('--var_range', help='range of the RBF kernel variance', default=[0.5, 0.5], nargs=2, type=float)
+    parser.add_argument('--jitter', help='diagonal jitter added before the Cholesky factorization', default=1e-6, type=float)
+    parser.add_argument('--chunk_size', help='number of functions factorized at once', default=256, type=int)
+    parser.add_argument('--processes', help='number of worker processes (all cores by default)', default=None, type=int)
+    parser.add_argument('--seed', help='base random seed, shard i draws from item_rng(seed, i)', default=0, type=int)
+    return parser
+
+
+def shard_name(index):
+    return "shard-{0:05d}".format(index)
+
+
+def generate_shard(shard):
+    """
+    Generate one shard described by a manifest entry and write it to disk.
+    """
+    rng = item_rng(shard['seed'], *shard['spawn_key'])
+    sampler = GPSample(input_range=shard['input_range'], var_range=shard['var_range'], max_num_samples=shard['num_samples'], jitter=shard['jitter'])
+    xs = np.zeros((shard['num_functions'], shard['num_samples'], 1), dtype=np.float32)
+    ys = np.zeros((shard['num_functions'], shard['num_samples']), dtype=np.float32)
+    for i in range(0, shard['num_functions'], shard['chunk_size']):
+        num = min(shard['chunk_size'], shard['num_functions'] - i)
+        xs_chunk, ys_chunk = sampler.sample_arrays(num, rng=rng)
+        xs[i:i+num, :, 0] = xs_chunk
+        ys[i:i+num] = ys_chunk
+    for key, value in [('xs', xs), ('ys', ys)]:
+        path = os.path.join(shard['output_dir'], shard[key])
+        np.save(path + ".tmp.npy", value)
+        os.rename(path + ".tmp.npy", path)
+    return shard['name']
+
+
+def main(args):
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    shards = []
+    for index, start in enumerate(range(0, args.num_functions, args.shard_size)):
+        name = shard_name(index)
+        shards.append({
+            "name": name,
+            "xs": name + "-xs.npy",
+            "ys": name + "-ys.npy",
+            "num_functions": min(args.shard_size, args.num_functions - start),
+            "num_samples": args.num_samples,
+            "seed": args.seed,
+            "spawn_key": [index],
+            "kernel": "rbf",
+            "input_range": list(args.input_range),
+            "var_range": list(args.var_range),
+            "jitter": args.jitter,
+        })
+    jobs = [dict(shard, output_dir=args.output_dir, chunk_size=args.chunk_size) for shard in shards]
+
+    start_time = time.time()
+    with Pool(args.processes) as pool:
+        for k, name in enumerate(pool.imap_unordered(generate_shard, jobs)):
+            print("{0} done ({1}/{2}, {3:0.1f}s)".format(name, k+1, len(jobs), time.time()-start_time))
+
+    manifest = {
+        "num_functions": args.num_functions,
+        "num_samples": args.num_samples,
+        "dtype": "float32",
+        "shards": shards,
+    }
+    with open(os.path.join(args.output_dir, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+if __name__ == '__main__':
+    main(argument_parser().parse_args())
@@ -1,9 +1,12 @@
 import sys
 import random
 import time
+from contextlib import contextmanager
 import numpy as np
 import tensorflow as tf
 from misc.optimizers import adam_updates
+from data.sampling import draw_shots, fixed_seed, item_rng
+from .prefetch import Prefetcher, ProcessPrefetcher
 
 def cosort_x(x, y):
     p = np.argsort(x)
@@ -11,6 +14,9 @@ def cosort_x(x, y):
 
 class MetaLearner(object):
 
+    # whether the target set fed to a model also contains the context points
+    include_context = False
+
     def __init__(self, session, parallel_models, optimize_op, train_set=None, eval_set=None, variables=None, lr=0.001, device_type='gpu', tags=["test"], cdir="", rdir=""):
 
         self.session = session
@@ -24,6 +30,20 @@ class MetaLearner(object):
         self.clock = time.time()
         self.train_set = train_set
         self.eval_set = eval_set
+        self.prefetcher = None
+        # meta-batch i of training is drawn from item_rng(seed, i), i being
+        # the step, restored from the global step of a checkpoint (see
+        # restore_step). Without a seed, from the global numpy RNG.
+        self.seed = None
+        self.step = 0
+        # forked but not yet started ProcessPrefetcher, see fork_workers
+        self._workers = None
+        # placeholders fed per step, in a fixed order, see _run
+        self._feed_list = tuple(t for m in self.parallel_models for t in self._model_feed_list(m))
+        self._feed_set = frozenset(self._feed_list)
+        # order of any other set of feeds, by frozenset of the feeds
+        self._feed_orders = {}
+        self._callables = {}
 
         self.lr = lr
         self.save_dir = self.train_set.dataset_name + "-" + "-".join(tags)
@@ -42,6 +62,11 @@ class MetaLearner(object):
         self.aggregated_grads = grads[0]
 
         self.optimize_op = adam_updates(variables, self.aggregated_grads, lr=self.lr)
+        # in-graph task generators are seeded with the global step, and the
+        # step of host-sampled meta-batches is restored from it
+        self.global_step = tf.train.get_or_create_global_step()
+        with tf.control_dependencies([self.optimize_op]):
+            self.optimize_op = tf.assign_add(self.global_step, 1)
 
 
     def qclock(self):
@@ -50,35 +75,256 @@ class MetaLearner(object):
         self.clock = cur_time
         return tdiff
 
+    def restore_checkpoint(self, ckpt_file):
+        """
+        Restore the variables and the global step from ckpt_file. Checkpoints
+        written before the global step was saved leave it at 0.
+        """
+        tf.train.Saver(var_list=self.variables).restore(self.get_session(), ckpt_file)
+        if tf.train.NewCheckpointReader(ckpt_file).has_tensor(self.global_step.op.name):
+            tf.train.Saver(var_list=[self.global_step]).restore(self.get_session(), ckpt_file)
+        else:
+            print("no global step in {0}, starting at step 0".format(ckpt_file))
+            self.global_step.load(0, self.get_session())
+
+    def restore_step(self):
+        """
+        Continue the sequence of meta-batches from the global step, e.g.
+        after restoring a checkpoint, and restart the input sources that
+        depend on it (see misc.episodes.EpisodeSource).
+        """
+        self.step = int(self.get_session().run(self.global_step))
+        for m in self.parallel_models:
+            if getattr(m, "inputs", None) is not None:
+                m.inputs.restart(self.get_session())
+
     def set_session(self, sess):
         self.session = sess
+        self._callables = {}
+        for m in self.parallel_models:
+            if getattr(m, "inputs", None) is not None:
+                m.inputs.initialize(sess)
 
     def get_session(self):
         return self.session
 
-    def train(self, meta_batch, gen_num_shots, gen_test_shots):
+    def _step_callable(self, fetches, feed_list):
+        """
+        A function running fetches given the values of feed_list, compiled
+        once with Session.make_callable and cached by fetches and feeds.
+        Sessions without make_callable (e.g. debug wrappers) fall back to
+        session.run.
+        """
+        key = (tuple(fetches) if isinstance(fetches, list) else fetches, feed_list)
+        if key not in self._callables:
+            session = self.get_session()
+            if hasattr(session, "make_callable"):
+                self._callables[key] = session.make_callable(fetches, feed_list=list(feed_list))
+            else:
+                self._callables[key] = lambda *values: session.run(fetches, feed_dict=dict(zip(feed_list, values)))
+        return self._callables[key]
+
+    def _feed_order(self, feeds):
+        """
+        The tensors of feeds ordered by name, sorted once per set of feeds.
+        """
+        feeds = frozenset(feeds)
+        if feeds not in self._feed_orders:
+            self._feed_orders[feeds] = tuple(sorted(feeds, key=lambda t: t.name))
+        return self._feed_orders[feeds]
+
+    def _run(self, fetches, feed_dict):
+        """
+        session.run(fetches, feed_dict) through a cached callable. Feed
+        dicts of the per-replica placeholders use the order fixed at
+        construction; any other set of feeds is ordered by name.
+        """
+        if len(feed_dict) == len(self._feed_list) and self._feed_set.issuperset(feed_dict):
+            feed_list = self._feed_list
+        else:
+            feed_list = self._feed_order(feed_dict)
+        return self._step_callable(fetches, feed_list)(*[feed_dict[t] for t in feed_list])
+
+    def _in_graph_tasks(self):
+        """
+        True if every model generates its tasks in the graph, so that
+        nothing has to be sampled or fed on the host.
+        """
+        return all(getattr(m, "inputs", None) is not None and not m.inputs.needs_task for m in self.parallel_models)
+
+    def _placeholder_inputs(self):
+        return all(getattr(m, "inputs", None) is None for m in self.parallel_models)
+
+    @staticmethod
+    def _model_feed_list(m):
+        return (m.X_c, m.y_c, m.X_t, m.y_t, m.is_training)
+
+    def _task_feed_values(self, m, task, num_shots, test_shots, is_training=True, rng=None):
+        """
+        Feeds of one model for one task, through the model's input source
+        if it has one, as a tuple of tensors and the list of their values.
+        Without an input source, the tensors are _model_feed_list(m).
+        """
+        if getattr(m, "inputs", None) is not None and m.inputs.needs_task:
+            feed_dict = m.inputs.feed(task, num_shots, test_shots, rng=rng)
+            feed_list = self._feed_order(feed_dict)
+            return feed_list + (m.is_training,), [feed_dict[t] for t in feed_list] + [is_training]
+        X_c_value, y_c_value, X_t_value, y_t_value = task.sample(num_shots, test_shots, rng=rng)
+        if self.include_context:
+            X_t_value = np.concatenate([X_c_value, X_t_value], axis=0)
+            y_t_value = np.concatenate([y_c_value, y_t_value], axis=0)
+        return self._model_feed_list(m), [X_c_value, y_c_value, X_t_value, y_t_value, is_training]
+
+    def _batch_feed_values(self, dataset, meta_batch, gen_num_shots, gen_test_shots, is_training=True, rng=None):
+        """
+        Values of self._feed_list for a meta-batch drawn with
+        dataset.sample_batch, for datasets that declare batched_sampling.
+        Context and target sets are slices of the batched arrays, so no
+        per-task concatenation is needed.
+        """
+        num_shots = [draw_shots(gen_num_shots, rng) for i in range(meta_batch)]
+        test_shots = [draw_shots(gen_test_shots, rng) for i in range(meta_batch)]
+        xs, ys, num_shots, test_shots = dataset.sample_batch(meta_batch, num_shots, test_shots, rng=rng)
+        return self._arrays_feed_values(xs, ys[..., 0], num_shots, test_shots, is_training)
+
+    def _arrays_feed_values(self, xs, ys, num_shots, test_shots, is_training=True):
+        """
+        Values of the per-replica placeholders (in the order of
+        self._feed_list) for a meta-batch given as padded arrays: task i
+        has its context in the first num_shots[i] rows of xs[i], ys[i]
+        and its target in the next test_shots[i] (rows, not shots, for
+        N-way tasks, see ProcessPrefetcher).
+        """
+        values = []
+        for i in range(len(num_shots)):
+            n, m = num_shots[i], num_shots[i] + test_shots[i]
+            t = 0 if self.include_context else n
+            values += [xs[i, :n], ys[i, :n], xs[i, t:m], ys[i, t:m], is_training]
+        return values
+
+    def _train_feeds(self, meta_batch, gen_num_shots, gen_test_shots, rng=None):
+        """
+        Feeds of one training step, as a tuple of tensors and the list of
+        their values (self._feed_list unless models have input sources).
+        Tasks, shot counts and splits are drawn from rng if given
+        (gen_num_shots and gen_test_shots are then called with it, see
+        data.sampling.ShotRange), otherwise from the global numpy RNG.
+        """
+        if self._in_graph_tasks():
+            return tuple(m.is_training for m in self.parallel_models), [True] * self.nr_model
+        if getattr(self.train_set, "batched_sampling", False) and self._placeholder_inputs():
+            return self._feed_list, self._batch_feed_values(self.train_set, meta_batch, gen_num_shots, gen_test_shots, rng=rng)
+        tasks = self.train_set.sample(meta_batch, rng=rng)
+        feed_list, values = (), []
+        for m, task in zip(self.parallel_models, tasks):
+            f, v = self._task_feed_values(m, task, draw_shots(gen_num_shots, rng), draw_shots(gen_test_shots, rng), rng=rng)
+            feed_list += f
+            values += v
+        return feed_list, values
+
+    def _train_step(self, feeds):
+        feed_list, values = feeds
+        self._step_callable(self.optimize_op, feed_list)(*values)
+
+    def fork_workers(self, meta_batch, gen_num_shots, gen_test_shots, num_processes, capacity=4, max_points=None, seed=0):
+        """
+        Fork num_processes worker processes sampling tasks into capacity
+        shared memory slots holding up to max_points shots per task (N
+        rows per shot for N-way tasks, see ProcessPrefetcher). Call this
+        before creating the tf.Session, as forking a process running
+        TensorFlow can deadlock the workers. They start sampling with
+        start_prefetch(num_processes=...). max_points defaults to the most
+        shots the ShotRanges gen_num_shots and gen_test_shots can draw
+        together. Sets the seed of training meta-batches.
+        """
         assert meta_batch==self.nr_model, "nr_model != meta_batch"
-        tasks = self.train_set.sample(meta_batch)
-        feed_dict = {}
-        for i, task in enumerate(tasks):
-            num_shots = gen_num_shots()
-            test_shots = gen_test_shots()
+        assert self._placeholder_inputs(), "process prefetching feeds the placeholders of the models"
+        if max_points is None:
+            max_points = gen_num_shots.high - 1 + gen_test_shots.high - 1
+        self.seed = seed
+        self._workers = ProcessPrefetcher(self.train_set, meta_batch, gen_num_shots, gen_test_shots, max_points, capacity, num_processes, seed)
+
+    def start_prefetch(self, meta_batch, gen_num_shots, gen_test_shots, capacity=4, num_threads=1, num_processes=0):
+        """
+        Build the next meta-batches in the background while the current
+        step runs. train() then takes its feed from the prefetcher, the
+        arguments given to train() are ignored.
+        With num_processes > 0, tasks are sampled by the worker processes
+        forked with fork_workers (which take their arguments from there),
+        otherwise the feeds are built by num_threads threads.
+        Prefetching starts at meta-batch self.step, each drawn from
+        item_rng(self.seed, step) as in train() without prefetching, and
+        meta-batches are consumed in order, so training sees the same
+        sequence whatever the number of threads or processes. With seed
+        None, threads draw from the global numpy RNG instead.
+        """
+        assert meta_batch==self.nr_model, "nr_model != meta_batch"
+        workers, self._workers = self._workers, None
+        self.stop_prefetch()
+        if num_processes > 0:
+            assert workers is not None, "fork the worker processes with fork_workers before creating the tf.Session"
+            self.prefetcher = workers
+            assert self.prefetcher.seed == self.seed, "workers were forked with seed {0}, not {1}".format(self.prefetcher.seed, self.seed)
+            self.prefetcher.start(self.step)
+            self._prefetch_step = lambda slot: self._step_callable(self.optimize_op, self._feed_list)(*self._arrays_feed_values(*slot))
+        else:
+            if workers is not None:
+                workers.close()
+            make_feeds = lambda rng=None: self._train_feeds(meta_batch, gen_num_shots, gen_test_shots, rng)
+            self.prefetcher = Prefetcher(make_feeds, capacity, num_threads, self.seed, self.step)
+            self._prefetch_step = self._train_step
+
+    def stop_prefetch(self):
+        """
+        Stop the prefetcher, and the worker processes of fork_workers if
+        they were never started.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self._workers is not None:
+            self._workers.close()
+            self._workers = None
+
+    @contextmanager
+    def _fixed_seed(self, seed):
+        """
+        fixed_seed with prefetching paused, so that no task of the seeded
+        block is drawn by a producer thread.
+        """
+        if self.prefetcher is None:
+            with fixed_seed(seed):
+                yield
+        else:
+            with self.prefetcher.paused(), fixed_seed(seed):
+                yield
 
-            X_c_value, y_c_value, X_t_value, y_t_value = task.sample(num_shots, test_shots)
-            X_value = np.concatenate([X_c_value, X_t_value], axis=0)
-            y_value = np.concatenate([y_c_value, y_t_value], axis=0)
-            feed_dict.update({
-                self.parallel_models[i].X_c: X_c_value,
-                self.parallel_models[i].y_c: y_c_value,
-                self.parallel_models[i].X_t: X_t_value,
-                self.parallel_models[i].y_t: y_t_value,
-                self.parallel_models[i].is_training: True,
-            })
-        self.get_session().run(self.optimize_op, feed_dict=feed_dict)
+    def train(self, meta_batch, gen_num_shots, gen_test_shots):
+        """
+        One optimization step, on the next prefetched meta-batch if
+        start_prefetch has been called, otherwise on one sampled here.
+        """
+        assert meta_batch==self.nr_model, "nr_model != meta_batch"
+        if self.prefetcher is not None:
+            self._prefetch_step(self.prefetcher.get())
+            self.prefetcher.release()
+        else:
+            rng = None if self.seed is None else item_rng(self.seed, self.step)
+            self._train_step(self._train_feeds(meta_batch, gen_num_shots, gen_test_shots, rng))
+        self.step += 1
 
 
 
-    def evaluate(self, eval_samples, gen_num_shots, gen_test_shots):
+    def evaluate(self, eval_samples, gen_num_shots, gen_test_shots, seed=None):
+        """
+        With a seed, tasks and splits are drawn with common random numbers,
+        i.e. the same ones for every call (and checkpoint or model).
+        """
+        if seed is not None:
+            with self._fixed_seed(seed):
+                if hasattr(self.eval_set, "reset"):
+                    self.eval_set.reset()
+                return self.evaluate(eval_samples, gen_num_shots, gen_test_shots)
         evals = []
         eval_meta_batch = eval_samples // self.nr_model
         for i in range(eval_meta_batch):
@@ -101,7 +347,7 @@ class MetaLearner(object):
                 ops, d = self.parallel_models[k].evaluate_metrics(X_c_value, y_c_value, X_t_value, y_t_value, step=3)
                 run_ops += ops
                 feed_dict.update(d)
-            ls = np.array(self.get_session().run(run_ops, feed_dict=feed_dict))
+            ls = np.array(self._run(run_ops, feed_dict))
             ls = np.reshape(ls, (self.nr_model, len(ls)//self.nr_model))
             ls = np.mean(ls, axis=0)
             evals.append(ls)
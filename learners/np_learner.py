@@ -4,12 +4,19 @@ import time
 import random
 import numpy as np
 import tensorflow as tf
-import matplotlib.pyplot as plt
-plt.style.use("ggplot")
 from .meta_learner import MetaLearner, cosort_x
+from data.image_cache import shared_cache
+
+def _pyplot():
+    # matplotlib is only loaded once something is plotted
+    import matplotlib.pyplot as plt
+    plt.style.use("ggplot")
+    return plt
 
 class NPLearner(MetaLearner):
 
+    include_context = True
+
     def __init__(self, session, parallel_models, optimize_op, train_set=None, eval_set=None, variables=None, lr=0.001, device_type='gpu', tags=["test"], cdir="", rdir=""):
         super().__init__(session, parallel_models, optimize_op, train_set, eval_set, variables, lr, device_type, tags)
         self.checkpoint_dir = os.path.join(cdir, "neural_processes", self.save_dir)
@@ -18,30 +25,29 @@ class NPLearner(MetaLearner):
             os.makedirs(self.checkpoint_dir)
         if not os.path.exists(self.result_dir):
             os.makedirs(self.result_dir)
-
-
-    def train(self, meta_batch, gen_num_shots, gen_test_shots):
-        assert meta_batch==self.nr_model, "nr_model != meta_batch"
-        tasks = self.train_set.sample(meta_batch)
-        feed_dict = {}
-        for i, task in enumerate(tasks):
-            num_shots = gen_num_shots()
-            test_shots = gen_test_shots()
-
-            X_c_value, y_c_value, X_t_value, y_t_value = task.sample(num_shots, test_shots)
-            X_value = np.concatenate([X_c_value, X_t_value], axis=0)
-            y_value = np.concatenate([y_c_value, y_t_value], axis=0)
-            feed_dict.update({
-                self.parallel_models[i].X_c: X_c_value,
-                self.parallel_models[i].y_c: y_c_value,
-                self.parallel_models[i].X_t: X_value,
-                self.parallel_models[i].y_t: y_value,
-                self.parallel_models[i].is_training: True,
-            })
-        self.get_session().run(self.optimize_op, feed_dict=feed_dict)
-
-    def evaluate(self, eval_samples, gen_num_shots, gen_test_shots):
-        evals = []
+        # [mse, nll] of the oracle in the last evaluate(oracle=...)
+        self.oracle_metrics = None
+
+
+    def evaluate(self, eval_samples, gen_num_shots, gen_test_shots, oracle=None, seed=None, antithetic=False, feed_eps=False):
+        """
+        If an oracle (e.g. data.gpsample.GPOracle) is given, it is evaluated
+        on the same context/target splits, and [mse, nll] of the oracle is
+        stored in self.oracle_metrics.
+        With feed_eps, the latent noise of the models is drawn on the host
+        (from the numpy RNG) and fed, instead of by tf.random_normal.
+        With a seed, tasks, splits and latent noise (feed_eps is implied)
+        are drawn with common random numbers.
+        With antithetic (implies feed_eps), every task is evaluated with
+        latent noise eps and -eps and the two results are averaged (models
+        in 'train' user_mode).
+        """
+        if seed is not None:
+            with self._fixed_seed(seed):
+                if hasattr(self.eval_set, "reset"):
+                    self.eval_set.reset()
+                return self.evaluate(eval_samples, gen_num_shots, gen_test_shots, oracle=oracle, antithetic=antithetic, feed_eps=True)
+        evals, oracle_evals = [], []
         eval_meta_batch = eval_samples // self.nr_model
         for i in range(eval_meta_batch):
             tasks = self.eval_set.sample(self.nr_model)
@@ -49,18 +55,34 @@ class NPLearner(MetaLearner):
             test_shots = gen_test_shots()
 
             run_ops, feed_dict = [], {}
+            splits = []
             for k, task in enumerate(tasks):
                 X_c_value, y_c_value, X_t_value, y_t_value = task.sample(num_shots, test_shots)
-                X_value = np.concatenate([X_c_value, X_t_value], axis=0)
-                y_value = np.concatenate([y_c_value, y_t_value], axis=0)
+                splits.append((X_c_value, y_c_value, X_t_value, y_t_value))
                 ## !! training data is not included in the evaluation, different from neural process
                 ops, d = self.parallel_models[k].evaluate_metrics(X_c_value, y_c_value, X_t_value, y_t_value)
                 run_ops += ops
                 feed_dict.update(d)
-            ls = np.array(self.get_session().run(run_ops, feed_dict=feed_dict))
+            if antithetic or feed_eps:
+                eps_feed = {}
+                for m in self.parallel_models:
+                    assert m.z_eps is not None or not antithetic, "antithetic evaluation needs latent sampling (user_mode='train')"
+                    # models in 'eval' user_mode use the posterior mean, there is no noise to feed
+                    if m.z_eps is not None:
+                        eps_feed[m.z_eps] = np.random.normal(size=m.z_eps.get_shape().as_list())
+                feed_dict.update(eps_feed)
+            ls = np.array(self._run(run_ops, feed_dict))
+            if antithetic:
+                feed_dict.update({k: -v for k, v in eps_feed.items()})
+                ls = (ls + np.array(self._run(run_ops, feed_dict))) / 2.
             ls = np.reshape(ls, (self.nr_model, len(ls)//self.nr_model))
             ls = np.mean(ls, axis=0)
             evals.append(ls)
+            if oracle is not None:
+                mse, nll = oracle.evaluate(*[np.stack(v) for v in zip(*splits)])
+                oracle_evals.append([np.mean(mse), np.mean(nll)])
+        if oracle is not None:
+            self.oracle_metrics = np.mean(oracle_evals, axis=0)
         return np.mean(evals, axis=0)
 
 
@@ -90,6 +112,7 @@ class NPLearner(MetaLearner):
 
 
     def visualise_1d(self, save_name):
+        plt = _pyplot()
         fig = plt.figure(figsize=(10, 10))
         for i in range(12):
             ax = fig.add_subplot(4, 3, i+1)
@@ -116,6 +139,7 @@ class NPLearner(MetaLearner):
 
     def visualise_2d(self, save_name):
         m = self.parallel_models[0]
+        plt = _pyplot()
         fig = plt.figure(figsize=(12, 10))
         sampler = self.eval_set.sample(1)[0]
 
@@ -140,31 +164,51 @@ class NPLearner(MetaLearner):
         plt.close()
 
 
-    def run_train(self, num_epoch, eval_interval, save_interval, eval_samples, meta_batch, gen_num_shots, gen_test_shots, load_params=False):
-        saver = tf.train.Saver(var_list=self.variables)
-        if load_params:
-            ckpt_file = self.checkpoint_dir + '/params.ckpt'
-            print('restoring parameters from', ckpt_file)
-            saver.restore(self.session, ckpt_file)
-        self.visualise_2d(os.path.join(self.result_dir, "{0}-{1}.pdf".format(self.eval_set.dataset_name, 0)))
-
-        for epoch in range(1, num_epoch+1):
-            self.qclock()
-            for k in range(1000):
-                self.train(meta_batch, gen_num_shots, gen_test_shots)
-            train_time = self.qclock()
-            print("Epoch {0}: {1:0.3f}s ...................".format(epoch, train_time))
-            if epoch % eval_interval == 0:
-                v = self.evaluate(eval_samples, gen_num_shots, gen_test_shots)
-                print("    Eval Loss: ", v)
-                # v = self.test(eval_samples, num_shots, test_shots)
-
-            if epoch % save_interval == 0:
-                print("\tsave figure")
-                self.visualise_2d(os.path.join(self.result_dir, "{0}-{1}.pdf".format(self.eval_set.dataset_name, epoch)))
-                print("\tsave checkpoint")
-                saver.save(self.session, self.checkpoint_dir + '/params.ckpt')
-            sys.stdout.flush()
+    def run_train(self, num_epoch, eval_interval, save_interval, eval_samples, meta_batch, gen_num_shots, gen_test_shots, load_params=False, oracle=None, eval_seed=None, antithetic=False, prefetch=0, prefetch_threads=1, prefetch_processes=0, seed=0):
+        # the global step is saved too, so that a resumed run continues the
+        # sequence of meta-batches
+        saver = tf.train.Saver(var_list=self.variables + [self.global_step])
+        # producer threads, worker processes (also those of fork_workers) and
+        # shared memory are released even if restoring, a step, the
+        # prefetcher or an evaluation raises
+        try:
+            if load_params:
+                ckpt_file = self.checkpoint_dir + '/params.ckpt'
+                print('restoring parameters from', ckpt_file)
+                self.restore_checkpoint(ckpt_file)
+            self.seed = seed
+            self.restore_step()
+            self.visualise_2d(os.path.join(self.result_dir, "{0}-{1}.pdf".format(self.eval_set.dataset_name, 0)))
+            if prefetch > 0:
+                self.start_prefetch(meta_batch, gen_num_shots, gen_test_shots, capacity=prefetch, num_threads=prefetch_threads,
+                                    num_processes=prefetch_processes)
+
+            for epoch in range(1, num_epoch+1):
+                self.qclock()
+                for k in range(1000):
+                    self.train(meta_batch, gen_num_shots, gen_test_shots)
+                train_time = self.qclock()
+                print("Epoch {0}: {1:0.3f}s ...................".format(epoch, train_time))
+                image_cache = shared_cache()
+                if image_cache.misses > 0:
+                    print("    Image cache: ", image_cache)
+                if self.prefetcher is not None:
+                    print("    Prefetch: ", self.prefetcher)
+                if epoch % eval_interval == 0:
+                    v = self.evaluate(eval_samples, gen_num_shots, gen_test_shots, oracle=oracle, seed=eval_seed, antithetic=antithetic)
+                    print("    Eval Loss: ", v)
+                    if oracle is not None:
+                        print("    Oracle [mse, nll]: ", self.oracle_metrics)
+                    # v = self.test(eval_samples, num_shots, test_shots)
+
+                if epoch % save_interval == 0:
+                    print("\tsave figure")
+                    self.visualise_2d(os.path.join(self.result_dir, "{0}-{1}.pdf".format(self.eval_set.dataset_name, epoch)))
+                    print("\tsave checkpoint")
+                    saver.save(self.session, self.checkpoint_dir + '/params.ckpt')
+                sys.stdout.flush()
+        finally:
+            self.stop_prefetch()
 
     def run_eval(self, num_func, num_shots, test_shots):
         saver = tf.train.Saver(var_list=self.variables)
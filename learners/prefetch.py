@@ -0,0 +1,319 @@
+"""
+Background producers of training feeds, so that sampling tasks and
+building feed dicts overlaps with session.run.
+"""
+
+import time
+import queue
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from contextlib import contextmanager
+import numpy as np
+from data.sampling import draw_shots, item_rng
+
+
+class Prefetcher(object):
+    """
+    Call make_item() in num_threads background threads and keep up to
+    capacity results ready in a bounded queue. The consumer calls get() for
+    the next item and release() once it is done with it.
+
+    A get() that finds the queue empty is a stall: the consumer waits for
+    the input pipeline. Many stalls mean training is input-bound; a producer
+    that often finds the queue full means it keeps up.
+
+    With several threads, make_item has to be thread-safe: numpy's global
+    RandomState is, and the datasets' EpochPermutation is locked; other
+    shared sampler state needs num_threads=1.
+
+    With a seed, item i is made by make_item(rng) with its own stream
+    rng = item_rng(seed, i) and items are queued in order, so the sequence
+    of items does not depend on num_threads. Items are numbered from
+    first_index.
+    """
+
+    def __init__(self, make_item, capacity=4, num_threads=1, seed=None, first_index=0):
+        self.make_item = make_item
+        self.capacity = capacity
+        self.seed = seed
+        self.num_gets = 0
+        self.num_stalls = 0
+        self.stall_time = 0.
+        self.num_full = 0
+        self._queue = queue.Queue(maxsize=capacity)
+        self._stop = threading.Event()
+        self._cond = threading.Condition()
+        self._paused = False
+        self._active = 0
+        self._next_item = first_index
+        self._next_put = first_index
+        self._threads = [threading.Thread(target=self._produce, daemon=True) for _ in range(num_threads)]
+        for t in self._threads:
+            t.start()
+
+    def _produce(self):
+        while not self._stop.is_set():
+            with self._cond:
+                while self._paused and not self._stop.is_set():
+                    self._cond.wait()
+                self._active += 1
+                index = self._next_item
+                self._next_item += 1
+            try:
+                item = self.make_item() if self.seed is None else self.make_item(item_rng(self.seed, index))
+            except Exception as e:
+                item = _Failure(e)
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+            if self.seed is not None:
+                # wait for the items drawn before this one to be queued
+                with self._cond:
+                    while self._next_put != index and not self._stop.is_set():
+                        self._cond.wait()
+            if self._queue.full():
+                self.num_full += 1
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            with self._cond:
+                self._next_put += 1
+                self._cond.notify_all()
+
+    def get(self):
+        self.num_gets += 1
+        try:
+            item = self._queue.get_nowait()
+        except queue.Empty:
+            self.num_stalls += 1
+            start = time.time()
+            item = self._queue.get()
+            self.stall_time += time.time() - start
+        if isinstance(item, _Failure):
+            raise item.exception
+        return item
+
+    def release(self):
+        self._queue.task_done()
+
+    @contextmanager
+    def paused(self):
+        """
+        Run a block while no item is being produced, e.g. to draw from the
+        global RNG with a fixed seed.
+        """
+        with self._cond:
+            self._paused = True
+            while self._active > 0:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._paused = False
+                self._cond.notify_all()
+
+    def close(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+    def stats(self):
+        return {
+            "gets": self.num_gets,
+            "stalls": self.num_stalls,
+            "stall_time": self.stall_time,
+            "full": self.num_full,
+        }
+
+    def __str__(self):
+        return "{0} stalls in {1} steps ({2:0.3f}s waiting), queue full {3} times".format(
+            self.num_stalls, self.num_gets, self.stall_time, self.num_full)
+
+
+class _Failure(object):
+    # an exception raised by make_item, re-raised by get()
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class ProcessPrefetcher(object):
+    """
+    Sample meta-batches of a dataset (anything with sample(num) returning
+    tasks with sample(num_shots, test_shots)) in worker processes. Every
+    meta-batch is written into one of num_slots preallocated slots of a
+    shared memory block, and only the slot index is sent back, so nothing
+    is pickled or copied on the way.
+
+    get() returns (xs, ys, num_shots, test_shots), numpy views of a slot:
+    xs of shape [meta_batch, max_rows]+obs_shape, ys of shape
+    [meta_batch, max_rows]+label_shape, with the context of task i in
+    its first num_shots[i] rows and the target in the next test_shots[i].
+    num_shots and test_shots count rows, not shots: an N-way task (e.g.
+    omniglot.Characters) returns N rows per shot. max_rows is max_points
+    (in shots) times the rows per shot of a probe task. The views are
+    valid until release().
+
+    Workers are forked (the dataset is not pickled) at construction, which
+    has to happen before a tf.Session is created: a child forked from a
+    process already running TensorFlow (or CUDA) threads can deadlock on
+    the locks it inherits. They wait for meta-batches until start() is
+    called, e.g. once a checkpoint is restored. Meta-batch i is drawn
+    from its own stream item_rng(seed, i), whichever worker samples it, and
+    get() returns meta-batches in order, so the sequence does not depend
+    on num_workers. gen_num_shots and gen_test_shots are called with that
+    stream (see data.sampling.ShotRange).
+    """
+
+    def __init__(self, dataset, meta_batch, gen_num_shots, gen_test_shots, max_points, num_slots=8, num_workers=4, seed=0):
+        self.num_gets = 0
+        self.num_stalls = 0
+        self.stall_time = 0.
+        # infer shapes and dtypes from one task, drawn from a throwaway
+        # stream so that no training randomness (or epoch state) is used
+        rng = np.random.default_rng(0)
+        X_c, y_c, X_t, _ = dataset.sample(1, rng=rng)[0].sample(1, 1, rng=rng)
+        X_c, y_c = np.asarray(X_c), np.asarray(y_c)
+        max_rows = max_points * max(len(X_c), len(X_t))
+        layout = [
+            ((meta_batch, max_rows)+X_c.shape[1:], X_c.dtype),
+            ((meta_batch, max_rows)+y_c.shape[1:], y_c.dtype),
+            ((meta_batch,), np.int32),
+            ((meta_batch,), np.int32),
+        ]
+        self._layout, slot_size = _slot_layout(layout)
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_size * num_slots)
+        self._slots = [_slot_views(self._shm.buf, self._layout, k * slot_size) for k in range(num_slots)]
+        ctx = mp.get_context('fork')
+        self._free = ctx.Queue()
+        self._ready = ctx.Queue()
+        self.seed = seed
+        self.num_slots = num_slots
+        self._next_job = None
+        self._next_index = None
+        self._filled = {}
+        self._current = None
+        self._workers = []
+        for k in range(num_workers):
+            w = ctx.Process(target=_episode_worker, daemon=True, args=(
+                dataset, meta_batch, gen_num_shots, gen_test_shots, max_rows,
+                self._shm.name, self._layout, slot_size, self._free, self._ready, seed))
+            w.start()
+            self._workers.append(w)
+
+    def start(self, first_index=0):
+        """
+        Hand the slots to the workers, starting with meta-batch first_index.
+        """
+        assert self._next_index is None, "already started"
+        self._next_job = self._next_index = first_index
+        for k in range(self.num_slots):
+            self._release_slot(k)
+
+    def get(self):
+        assert self._next_index is not None, "start() the workers first"
+        assert self._current is None, "release() the previous meta-batch first"
+        self.num_gets += 1
+        start = None
+        # meta-batches filled ahead of the next one wait in self._filled
+        while self._next_index not in self._filled:
+            try:
+                msg = self._ready.get_nowait()
+            except queue.Empty:
+                if start is None:
+                    self.num_stalls += 1
+                    start = time.time()
+                msg = self._ready.get()
+            if isinstance(msg, str):
+                raise Exception("episode worker failed:\n" + msg)
+            k, index = msg
+            self._filled[index] = k
+        if start is not None:
+            self.stall_time += time.time() - start
+        self._current = self._filled.pop(self._next_index)
+        self._next_index += 1
+        return self._slots[self._current]
+
+    def release(self):
+        self._release_slot(self._current)
+        self._current = None
+
+    def _release_slot(self, k):
+        # hand slot k to a worker, for the next meta-batch
+        self._free.put((k, self._next_job))
+        self._next_job += 1
+
+    @contextmanager
+    def paused(self):
+        # workers draw from their own streams, seeded blocks are not affected
+        yield
+
+    def close(self):
+        for _ in self._workers:
+            self._free.put(None)
+        for w in self._workers:
+            w.join(timeout=10)
+            if w.is_alive():
+                w.terminate()
+        self._slots = None
+        self._shm.close()
+        self._shm.unlink()
+
+    def stats(self):
+        return {
+            "gets": self.num_gets,
+            "stalls": self.num_stalls,
+            "stall_time": self.stall_time,
+        }
+
+    def __str__(self):
+        return "{0} stalls in {1} steps ({2:0.3f}s waiting)".format(self.num_stalls, self.num_gets, self.stall_time)
+
+
+def _slot_layout(arrays, alignment=64):
+    """
+    Offsets of arrays (given as (shape, dtype)) within a slot, and the
+    slot size, each array aligned to alignment bytes.
+    """
+    layout, size = [], 0
+    for shape, dtype in arrays:
+        dtype = np.dtype(dtype)
+        layout.append((shape, dtype.str, size))
+        size += -(-int(np.prod(shape)) * dtype.itemsize // alignment) * alignment
+    return layout, size
+
+def _slot_views(buf, layout, start):
+    return tuple(np.ndarray(shape, dtype=dtype, buffer=buf, offset=start+offset) for shape, dtype, offset in layout)
+
+def _episode_worker(dataset, meta_batch, gen_num_shots, gen_test_shots, max_rows, shm_name, layout, slot_size, free, ready, seed):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    while True:
+        job = free.get()
+        if job is None:
+            break
+        k, index = job
+        try:
+            _fill_slot(_slot_views(shm.buf, layout, k * slot_size), dataset, meta_batch, gen_num_shots, gen_test_shots, max_rows, item_rng(seed, index))
+            ready.put((k, index))
+        except Exception:
+            ready.put(traceback.format_exc())
+    shm.close()
+
+def _fill_slot(slot, dataset, meta_batch, gen_num_shots, gen_test_shots, max_rows, rng):
+    xs, ys, num_shots, test_shots = slot
+    for i, task in enumerate(dataset.sample(meta_batch, rng=rng)):
+        X_c, y_c, X_t, y_t = task.sample(draw_shots(gen_num_shots, rng), draw_shots(gen_test_shots, rng), rng=rng)
+        # rows, which are shots times the number of ways for N-way tasks
+        n, m = len(X_c), len(X_t)
+        assert n + m <= max_rows, "context and target have {0} rows, but slots hold {1}".format(n+m, max_rows)
+        xs[i, :n], xs[i, n:n+m] = X_c, X_t
+        ys[i, :n], ys[i, n:n+m] = y_c, y_t
+        num_shots[i], test_shots[i] = n, m
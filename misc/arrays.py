@@ -0,0 +1,13 @@
+"""
+Numpy helpers that do not need TensorFlow, so that the data package can
+use them.
+"""
+
+import numpy as np
+
+
+def one_hot(y, num_classes):
+    y = np.array(y).astype(np.int32)
+    r = np.zeros((len(y), num_classes))
+    r[np.arange(len(y)), y] = 1
+    return r
@@ -0,0 +1,147 @@
+"""
+tf.data input pipeline of padded episodes. An episode is a point set xs
+of shape [max_points]+obs_shape with labels ys of shape [max_points], of
+which the first num_c points are the context and the next num_t the
+target; the rest is padding. Episodes are either sampled on the host in
+parallel map calls or read from TFRecord files written by
+write_episode_records.
+"""
+
+import numpy as np
+import tensorflow as tf
+from data.sampling import get_rng, item_rng
+from misc.inputs import InputSource
+
+
+def _max_shots(shots):
+    return shots if isinstance(shots, int) else shots[1] - 1
+
+def _draw_shots(shots, rng):
+    return shots if isinstance(shots, int) else shots[0] + int(rng.choice(shots[1] - shots[0]))
+
+
+def sample_episode(dataset, num_shots, test_shots, obs_shape, rng=None):
+    """
+    Sample one padded episode from a dataset. num_shots and test_shots
+    are ints, or pairs (low, high) drawn uniformly from [low, high).
+    Everything is drawn from rng, the global numpy RNG by default.
+    Returns:
+      A tuple (xs, ys, num_c, num_t).
+    """
+    rng = get_rng(rng)
+    max_points = _max_shots(num_shots) + _max_shots(test_shots)
+    num_c, num_t = _draw_shots(num_shots, rng), _draw_shots(test_shots, rng)
+    task = dataset.sample(1, rng=rng)[0]
+    X_c, y_c, X_t, y_t = task.sample(num_c, num_t, rng=rng)
+    xs = np.zeros([max_points]+obs_shape, dtype=np.float32)
+    ys = np.zeros([max_points], dtype=np.float32)
+    xs[:num_c], xs[num_c:num_c+num_t] = np.reshape(X_c, [num_c]+obs_shape), np.reshape(X_t, [num_t]+obs_shape)
+    ys[:num_c], ys[num_c:num_c+num_t] = y_c, y_t
+    return xs, ys, np.int32(num_c), np.int32(num_t)
+
+
+def episode_example(xs, ys, num_c, num_t):
+    bytes_feature = lambda v: tf.train.Feature(bytes_list=tf.train.BytesList(value=[v]))
+    int_feature = lambda v: tf.train.Feature(int64_list=tf.train.Int64List(value=[int(v)]))
+    return tf.train.Example(features=tf.train.Features(feature={
+        "xs": bytes_feature(xs.astype(np.float32).tobytes()),
+        "ys": bytes_feature(ys.astype(np.float32).tobytes()),
+        "num_c": int_feature(num_c),
+        "num_t": int_feature(num_t),
+    }))
+
+def write_episode_records(dataset, path, num_episodes, num_shots, test_shots, obs_shape, seed=None, first_episode=0):
+    """
+    With a seed, episode i is drawn from item_rng(seed, first_episode+i),
+    so that files written in parallel with disjoint episode ranges hold
+    the same episodes as one file written at once.
+    """
+    with tf.python_io.TFRecordWriter(path) as writer:
+        for i in range(first_episode, first_episode+num_episodes):
+            rng = None if seed is None else item_rng(seed, i)
+            writer.write(episode_example(*sample_episode(dataset, num_shots, test_shots, obs_shape, rng)).SerializeToString())
+
+def parse_episode(record, obs_shape):
+    features = tf.parse_single_example(record, {
+        "xs": tf.FixedLenFeature([], tf.string),
+        "ys": tf.FixedLenFeature([], tf.string),
+        "num_c": tf.FixedLenFeature([], tf.int64),
+        "num_t": tf.FixedLenFeature([], tf.int64),
+    })
+    xs = tf.reshape(tf.decode_raw(features["xs"], tf.float32), [-1]+obs_shape)
+    ys = tf.decode_raw(features["ys"], tf.float32)
+    return xs, ys, tf.cast(features["num_c"], tf.int32), tf.cast(features["num_t"], tf.int32)
+
+
+def episode_dataset(obs_shape, dataset=None, num_shots=None, test_shots=None, record_pattern=None, num_parallel_calls=4, prefetch=8, shuffle_buffer=1000, seed=None, replica=0, num_replicas=1):
+    """
+    An endless tf.data.Dataset of (xs, ys, num_c, num_t) episodes, read
+    from the TFRecord files matching record_pattern if given, otherwise
+    sampled from dataset in num_parallel_calls parallel map calls.
+    Sampling runs in tf.py_func, which holds the GIL, so parallel calls
+    only overlap it with the rest of the pipeline and add no sampling
+    throughput. For input-bound training, write records with
+    gen_episodes.py (in parallel processes) or use process prefetching.
+    With a seed, sampled episode i is drawn from item_rng(seed, i); map
+    keeps the order of its inputs, so the episode sequence does not
+    depend on num_parallel_calls. Records are then shuffled with the seed
+    too.
+    Build one dataset per replica: replica r of num_replicas gets the
+    episodes i = r (mod num_replicas), or every num_replicas-th record
+    file, so that the replicas of a step train on different episodes.
+    The dataset starts after the episodes of the first global_step steps
+    (one per step and replica), read when the iterator is initialized, so
+    that a resumed run continues the sequence (see EpisodeSource.restart).
+    """
+    step = tf.cast(tf.train.get_or_create_global_step(), tf.int64)
+    if record_pattern is not None:
+        # shard the files rather than the records, so that every replica
+        # only reads and parses its own records
+        files = sorted(tf.gfile.Glob(record_pattern))
+        assert len(files) >= num_replicas, "{0} replicas, but only {1} files match {2}".format(num_replicas, len(files), record_pattern)
+        files = files[replica::num_replicas]
+        episodes = tf.data.Dataset.from_tensor_slices(files).shuffle(len(files), seed=seed).repeat()
+        episodes = episodes.interleave(tf.data.TFRecordDataset, cycle_length=num_parallel_calls)
+        episodes = episodes.shuffle(shuffle_buffer, seed=seed)
+        # with a seed, this continues the record order of the resumed run
+        episodes = episodes.skip(step)
+        episodes = episodes.map(lambda r: parse_episode(r, obs_shape), num_parallel_calls=num_parallel_calls)
+    else:
+        if seed is None:
+            sample = lambda _: sample_episode(dataset, num_shots, test_shots, obs_shape)
+        else:
+            sample = lambda i: sample_episode(dataset, num_shots, test_shots, obs_shape, item_rng(seed, int(i)))
+        episodes = tf.data.Dataset.range(replica + step * num_replicas, np.iinfo(np.int64).max, num_replicas)
+        episodes = episodes.map(lambda i: tuple(tf.py_func(sample, [i], [tf.float32, tf.float32, tf.int32, tf.int32], stateful=True)),
+                                num_parallel_calls=num_parallel_calls)
+    return episodes.prefetch(prefetch)
+
+
+class EpisodeSource(InputSource):
+    """
+    Feed a model from an episode_dataset. No task is sampled or fed on the
+    host by the learner; the iterator is initialized in initialize(session).
+    """
+    needs_task = False
+
+    def __init__(self, episodes, obs_shape, include_context=False):
+        super().__init__(include_context)
+        self.iterator = episodes.make_initializable_iterator()
+        xs, ys, num_c, num_t = self.iterator.get_next()
+        xs.set_shape([None]+obs_shape)
+        ys.set_shape([None])
+        num_c.set_shape([])
+        num_t.set_shape([])
+        t = 0 if include_context else num_c
+        self.tensors = xs[:num_c], ys[:num_c], xs[t:num_c+num_t], ys[t:num_c+num_t]
+        self._sessions = set()
+
+    def initialize(self, session):
+        if session not in self._sessions:
+            session.run(self.iterator.initializer)
+            self._sessions.add(session)
+
+    def restart(self, session):
+        # the dataset starts at the global step, read by the initializer
+        session.run(self.iterator.initializer)
+        self._sessions.add(session)
@@ -3,13 +3,17 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.framework.python.ops import arg_scope, add_arg_scope
 from PIL import Image
+from misc.arrays import one_hot
 
-
-def one_hot(y, num_classes):
-    y = np.array(y).astype(np.int32)
-    r = np.zeros((len(y), num_classes))
-    r[np.arange(len(y)), y] = 1
-    return r
+def to_float_images(x, scale=1.):
+    """
+    cast images to float32 in the graph and multiply by scale. The datasets emit uint8 pixel values,
+    which are scaled the same whether they are fed to uint8 placeholders or converted to float32 ones
+    """
+    x = tf.cast(x, tf.float32)
+    if scale != 1.:
+        x = x * scale
+    return x
 
 def int_shape(x):
     to_int = lambda a: -1 if a.value is None else int(a)
@@ -0,0 +1,282 @@
+"""
+Alternative ways of feeding models. An input source builds the X_c, y_c,
+X_t, y_t tensors a model reads from (passed to construct as inputs=...),
+and turns a sampled task into the feed dict those tensors need.
+Models wrap the tensors in tf.placeholder_with_default, so feeding X_c,
+y_c, X_t, y_t directly (as evaluation and visualisation do) still works.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+stateless = tf.contrib.stateless
+
+
+class InputSource(object):
+
+    # whether the learner has to sample a task on the host for this source
+    needs_task = True
+
+    def __init__(self, include_context=False):
+        self.include_context = include_context
+        self.tensors = None
+
+    def feed(self, task, num_shots, test_shots, rng=None):
+        return {}
+
+    def initialize(self, session):
+        pass
+
+    def restart(self, session):
+        """
+        Called once the global step is restored, for sources whose tasks
+        depend on the step at initialization.
+        """
+        pass
+
+
+class PointSetSource(InputSource):
+    """
+    Feed one point set per task together with the context and target
+    counts. The graph draws a random split of the points: the first
+    num_c points of a random permutation are the context, the next num_t
+    the target (the target also starts with the context if include_context
+    is set). num_t defaults to all remaining points. Tasks must provide
+    sample_points(num_samples, rng), returning num_samples distinct points,
+    so that only the points of one step are fed.
+    """
+
+    def __init__(self, obs_shape, label_shape=[], include_context=False):
+        super().__init__(include_context)
+        self.X = tf.placeholder(tf.float32, shape=tuple([None,]+obs_shape))
+        self.y = tf.placeholder(tf.float32, shape=tuple([None,]+label_shape))
+        self.num_c = tf.placeholder(tf.int32, shape=())
+        self.num_t = tf.placeholder_with_default(-1, shape=())
+        num_samples = tf.shape(self.X)[0]
+        num_t = tf.where(self.num_t < 0, num_samples - self.num_c, self.num_t)
+        p = tf.random_shuffle(tf.range(num_samples))
+        c_idx = p[:self.num_c]
+        t_idx = p[:self.num_c+num_t] if include_context else p[self.num_c:self.num_c+num_t]
+        self.tensors = tf.gather(self.X, c_idx), tf.gather(self.y, c_idx), tf.gather(self.X, t_idx), tf.gather(self.y, t_idx)
+
+    def feed(self, task, num_shots, test_shots, rng=None):
+        xs, ys = task.sample_points(num_shots + test_shots, rng)
+        return {
+            self.X: xs,
+            self.y: ys,
+            self.num_c: num_shots,
+            self.num_t: test_shots,
+        }
+
+
+def task_seed(seed, replica):
+    """
+    Seed of the stateless in-graph task generators for one replica,
+    [seed * 2^32 + replica * 2^16, global_step]. The learner increments
+    the global step after every optimization step, so every step (and
+    every replica) draws different tasks, reproducibly. The low 16 bits
+    identify the sub-stream, see _sub_seed.
+    """
+    assert 0 <= replica < 2**16, "replica {0} out of range".format(replica)
+    step = tf.train.get_or_create_global_step()
+    return tf.stack([tf.constant(seed * 2**32 + replica * 2**16, dtype=tf.int64), tf.cast(step, tf.int64)])
+
+def _sub_seed(seed, k):
+    """
+    Seed of sub-stream k (0 <= k < 15) of seed. The path of sub-stream
+    ids is kept in the low 16 bits of seed[0], one base-16 digit k+1 per
+    level, so streams of different paths, replicas or seeds never share a
+    seed (up to 4 nested levels).
+    """
+    assert 0 <= k < 15, "sub-stream {0} out of range".format(k)
+    path = seed[0] % 2**16
+    return tf.stack([seed[0] - path + path * 16 + k + 1, seed[1]])
+
+def _uniform(shape, value_range, seed, dtype=tf.float32):
+    u = stateless.stateless_random_uniform(shape, seed=seed, dtype=dtype)
+    return value_range[0] + (value_range[1] - value_range[0]) * u
+
+def random_shots(shots, seed):
+    """
+    shots is either an int, or a pair (low, high) drawn uniformly from [low, high)
+    """
+    if isinstance(shots, int):
+        return tf.constant(shots, dtype=tf.int32)
+    u = _uniform([], [float(shots[0]), float(shots[1])], seed)
+    return tf.minimum(tf.cast(tf.floor(u), tf.int32), shots[1]-1)
+
+
+class InGraphTaskSource(InputSource):
+    """
+    Generate synthetic regression tasks in the graph. No task is sampled
+    or fed on the host.
+    """
+    needs_task = False
+
+    def __init__(self, seed, num_shots, test_shots, include_context=False):
+        super().__init__(include_context)
+        self.seed = seed
+        self.num_shots = random_shots(num_shots, _sub_seed(seed, 0))
+        self.test_shots = random_shots(test_shots, _sub_seed(seed, 1))
+        xs, ys = self._generate(self.num_shots + self.test_shots, _sub_seed(seed, 2))
+        t = 0 if include_context else self.num_shots
+        self.tensors = xs[:self.num_shots], ys[:self.num_shots], xs[t:], ys[t:]
+
+    def _generate(self, num_samples, seed):
+        raise NotImplementedError()
+
+
+class SinusoidTaskSource(InGraphTaskSource):
+
+    def __init__(self, dataset, seed, num_shots, test_shots, include_context=False):
+        self.amp_range = dataset.amp_range
+        self.phase_range = dataset.phase_range
+        self.period_range = dataset.period_range
+        self.input_range = dataset.input_range
+        super().__init__(seed, num_shots, test_shots, include_context)
+
+    def _generate(self, num_samples, seed):
+        amp = _uniform([], self.amp_range, _sub_seed(seed, 0))
+        phase = _uniform([], self.phase_range, _sub_seed(seed, 1))
+        period = _uniform([], self.period_range, _sub_seed(seed, 2))
+        xs = _uniform(tf.stack([num_samples, 1]), self.input_range, _sub_seed(seed, 3))
+        ys = amp * tf.sin( 2*np.pi*(xs[:, 0] - phase) / period )
+        return xs, ys
+
+
+class GPTaskSource(InGraphTaskSource):
+    """
+    Draw functions from the RBF GP prior of a GPSample dataset (not from its
+    stored functions). The Cholesky factorization runs in float64.
+    """
+
+    def __init__(self, dataset, seed, num_shots, test_shots, include_context=False, jitter=1e-4):
+        self.input_range = dataset.input_range
+        self.var_range = dataset.var_range
+        self.jitter = jitter
+        super().__init__(seed, num_shots, test_shots, include_context)
+
+    def _generate(self, num_samples, seed):
+        var = _uniform([], self.var_range, _sub_seed(seed, 0), dtype=tf.float64)
+        xs = _uniform(tf.stack([num_samples, 1]), self.input_range, _sub_seed(seed, 1), dtype=tf.float64)
+        gram = tf.exp(-tf.square(xs - tf.transpose(xs)) / (2*var)) + self.jitter * tf.eye(num_samples, dtype=tf.float64)
+        eps = stateless.stateless_random_normal(tf.stack([num_samples, 1]), seed=_sub_seed(seed, 2), dtype=tf.float64)
+        ys = tf.matmul(tf.cholesky(gram), eps)[:, 0]
+        return tf.cast(xs, tf.float32), tf.cast(ys, tf.float32)
+
+
+def in_graph_task_source(dataset, seed, replica, num_shots, test_shots, include_context=False):
+    sources = {
+        "sinusoid": SinusoidTaskSource,
+        "gpsamples": GPTaskSource,
+    }
+    if dataset.dataset_name not in sources:
+        raise Exception("no in-graph task generator for dataset {0}".format(dataset.dataset_name))
+    return sources[dataset.dataset_name](dataset, task_seed(seed, replica), num_shots, test_shots, include_context)
+
+
+class ImageBank(object):
+    """
+    A uint8 image array held in a graph variable, so that episodes can be
+    gathered on the device from small index tensors. The variable is
+    initialized from a placeholder, which keeps the array out of the graph
+    definition; it is a local variable, so call initialize(session) (the
+    learner does it in set_session) rather than relying on
+    tf.global_variables_initializer. Share one bank between replicas.
+    """
+
+    def __init__(self, images, name="image_bank"):
+        self.images = images
+        self._value = tf.placeholder(tf.uint8, shape=images.shape)
+        self.variable = tf.Variable(self._value, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name)
+        self._sessions = set()
+
+    def initialize(self, session):
+        if session not in self._sessions:
+            session.run(self.variable.initializer, feed_dict={self._value: np.asarray(self.images)})
+            self._sessions.add(session)
+
+
+def _shuffled(X, y):
+    p = tf.random_shuffle(tf.range(tf.shape(X)[0]))
+    return tf.gather(X, p), tf.gather(y, p)
+
+
+class OmniglotBankSource(InputSource):
+    """
+    N-way classification episodes of a packed Omniglot store, gathered from
+    an ImageBank of shape [num_chars, 20, 28, 28]. Only the (character,
+    rotation) pairs of the classes and the drawing ids of each class are fed.
+    Images are uint8 and labels int32 class ids, use models constructed
+    with obs_dtype=tf.uint8 and label_shape=[].
+    """
+
+    def __init__(self, bank, num_classes, include_context=False):
+        super().__init__(include_context)
+        self.bank = bank
+        self.classes = tf.placeholder(tf.int32, shape=(num_classes, 2))
+        self.drawings = tf.placeholder(tf.int32, shape=(num_classes, None))
+        self.num_c = tf.placeholder(tf.int32, shape=())
+        total_shots = tf.shape(self.drawings)[1]
+        chars = tf.tile(self.classes[:, :1], tf.stack([1, total_shots]))
+        imgs = tf.gather_nd(bank.variable, tf.stack([chars, self.drawings], axis=-1))[..., None]
+        # tf.image.rot90 rotates counter-clockwise, as np.rot90 does on the host
+        imgs = tf.map_fn(lambda a: tf.image.rot90(a[0], a[1]), (imgs, self.classes[:, 1]), dtype=tf.uint8)
+        labels = tf.tile(tf.range(num_classes)[:, None], tf.stack([1, total_shots]))
+        flatten = lambda a: tf.reshape(a, tf.concat([[-1], tf.shape(a)[2:]], axis=0))
+        t = 0 if include_context else self.num_c
+        X_c, y_c = _shuffled(flatten(imgs[:, :self.num_c]), flatten(labels[:, :self.num_c]))
+        X_t, y_t = _shuffled(flatten(imgs[:, t:]), flatten(labels[:, t:]))
+        self.tensors = X_c, y_c, X_t, y_t
+
+    def feed(self, task, num_shots, test_shots, rng=None):
+        return {
+            self.classes: task.classes,
+            self.drawings: task.sample_drawings(num_shots + test_shots, rng),
+            self.num_c: num_shots,
+        }
+
+    def initialize(self, session):
+        self.bank.initialize(session)
+
+
+class CelebABankSource(InputSource):
+    """
+    Image completion tasks of CelebA faces, gathered from an ImageBank of
+    shape [N, size, size, 3]. Only the image id and the pixel ids are fed.
+    """
+
+    def __init__(self, bank, include_context=False):
+        from data.celeba import pixel_grid
+        super().__init__(include_context)
+        self.bank = bank
+        self.image = tf.placeholder(tf.int32, shape=())
+        self.pixels = tf.placeholder(tf.int32, shape=(None,))
+        self.num_c = tf.placeholder(tf.int32, shape=())
+        gray = tf.reshape(tf.reduce_mean(tf.cast(bank.variable[self.image], tf.float32), axis=-1) / 255., [-1])
+        xs = tf.gather(tf.constant(pixel_grid(bank.images.shape[1])), self.pixels)
+        ys = tf.gather(gray, self.pixels)
+        t = 0 if include_context else self.num_c
+        self.tensors = xs[:self.num_c], ys[:self.num_c], xs[t:], ys[t:]
+
+    def feed(self, task, num_shots, test_shots, rng=None):
+        return {
+            self.image: task.index,
+            self.pixels: task.sample_pixels(num_shots + test_shots, rng),
+            self.num_c: num_shots,
+        }
+
+    def initialize(self, session):
+        self.bank.initialize(session)
+
+
+def image_bank_source(dataset, bank, include_context=False):
+    """
+    Input source gathering the tasks of a packed image dataset from bank,
+    an ImageBank of dataset.images.
+    """
+    if dataset.dataset_name.startswith("omniglot"):
+        return OmniglotBankSource(bank, dataset.num_classes, include_context)
+    if dataset.dataset_name == "celeba":
+        return CelebABankSource(bank, include_context)
+    raise Exception("no image bank input source for dataset {0}".format(dataset.dataset_name))
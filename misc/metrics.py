@@ -8,3 +8,9 @@ def accuracy(y, preds):
     cmp = tf.equal(tf.argmax(y, 1), tf.argmax(preds, 1))
     cmp = tf.cast(cmp, tf.float32)
     return tf.reduce_mean(cmp)
+
+def sparse_accuracy(y, preds):
+    """ accuracy for integer class ids y """
+    cmp = tf.equal(tf.cast(y, tf.int64), tf.argmax(preds, 1))
+    cmp = tf.cast(cmp, tf.float32)
+    return tf.reduce_mean(cmp)
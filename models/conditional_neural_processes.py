@@ -4,10 +4,11 @@ import tensorflow as tf
 from tensorflow.contrib.framework.python.ops import arg_scope, add_arg_scope
 from misc.layers import conv2d, deconv2d, dense
 from misc.samplers import gaussian_sampler
-from misc.helpers import int_shape, get_name, get_trainable_variables
+from misc.helpers import int_shape, get_name, get_trainable_variables, to_float_images
 from misc.estimators import compute_2gaussian_kld
 from misc.losses import mean_squared_error
-from misc.metrics import accuracy
+from misc.metrics import accuracy, sparse_accuracy
+from models.neural_processes import _segment_aggregate
 
 
 
@@ -17,15 +18,23 @@ class ConditionalNeuralProcess(object):
         self.counters = counters
         self.user_mode = user_mode
 
-    def construct(self, sample_encoder, aggregator, conditional_decoder, task_type, obs_shape, r_dim, z_dim, label_shape=[], num_classes=1, nonlinearity=tf.nn.relu, bn=False, kernel_initializer=None, kernel_regularizer=None):
+    def construct(self, sample_encoder, aggregator, conditional_decoder, task_type, obs_shape, r_dim, z_dim, label_shape=[], num_classes=1, nonlinearity=tf.nn.relu, bn=False, kernel_initializer=None, kernel_regularizer=None, inputs=None, obs_dtype=tf.float32):
         #
         self.sample_encoder = sample_encoder
         self.aggregator = aggregator
         self.conditional_decoder = conditional_decoder
         self.task_type = task_type
-        if task_type == 'classification':
+        self.label_dtype = tf.float32
+        if task_type == 'classification' and label_shape == []:
+            # integer class ids instead of one-hot labels
+            self.label_dtype = tf.int32
+            self.error_func = tf.losses.sparse_softmax_cross_entropy
+            self.pred_func = lambda x: tf.nn.softmax(x)
+            self.accuracy_func = sparse_accuracy
+        elif task_type == 'classification':
             self.error_func = tf.losses.softmax_cross_entropy
             self.pred_func = lambda x: tf.nn.softmax(x)
+            self.accuracy_func = accuracy
         elif task_type == 'regression':
             self.error_func = tf.losses.mean_squared_error
             self.pred_func = lambda x: x
@@ -41,10 +50,18 @@ class ConditionalNeuralProcess(object):
         self.kernel_initializer = kernel_initializer
         self.kernel_regularizer = kernel_regularizer
         #
-        self.X_c = tf.placeholder(tf.float32, shape=tuple([None,]+obs_shape))
-        self.y_c = tf.placeholder(tf.float32, shape=tuple([None,]+label_shape))
-        self.X_t = tf.placeholder(tf.float32, shape=tuple([None,]+obs_shape))
-        self.y_t = tf.placeholder(tf.float32, shape=tuple([None,]+label_shape))
+        self.inputs = inputs
+        if inputs is None:
+            self.X_c = tf.placeholder(obs_dtype, shape=tuple([None,]+obs_shape))
+            self.y_c = tf.placeholder(self.label_dtype, shape=tuple([None,]+label_shape))
+            self.X_t = tf.placeholder(obs_dtype, shape=tuple([None,]+obs_shape))
+            self.y_t = tf.placeholder(self.label_dtype, shape=tuple([None,]+label_shape))
+        else:
+            X_c, y_c, X_t, y_t = inputs.tensors
+            self.X_c = tf.placeholder_with_default(X_c, shape=tuple([None,]+obs_shape))
+            self.y_c = tf.placeholder_with_default(y_c, shape=tuple([None,]+label_shape))
+            self.X_t = tf.placeholder_with_default(X_t, shape=tuple([None,]+obs_shape))
+            self.y_t = tf.placeholder_with_default(y_t, shape=tuple([None,]+label_shape))
 
         self.is_training = tf.placeholder(tf.bool, shape=())
 
@@ -78,9 +95,11 @@ class ConditionalNeuralProcess(object):
                     r_c = self.sample_encoder(self.X_c, self.y_c, self.r_dim, self.num_classes)
                     self.r_c = r_c
                     if self.task_type == 'classification':
-                        self.r = self.aggregator(r_c, self.y_c, self.z_dim)
+                        self.r = self.aggregator(r_c, self.y_c, self.z_dim, num_classes=self.num_classes)
                     self.outputs = self.conditional_decoder(self.X_t, self.r, self.num_classes)
                     self.preds = self.pred_func(self.outputs)
+                    if self.task_type == 'classification':
+                        self.acc = self.accuracy_func(self.y_t, self.preds)
 
     def _loss(self):
         self.nll = self.error_func(self.y_t, self.outputs)
@@ -105,7 +124,7 @@ class ConditionalNeuralProcess(object):
             self.is_training: False,
         }
         if self.task_type == 'classification':
-            return [self.loss, accuracy(self.y_t, self.pred_func(self.outputs))], feed_dict
+            return [self.loss, self.acc], feed_dict
         return [self.loss], feed_dict
 
 
@@ -130,7 +149,7 @@ def omniglot_conv_encoder(X, y, r_dim, num_classes, is_training, nonlinearity=No
         stride = [2, 2]
         bsize = tf.shape(X)[0]
         with arg_scope([conv2d, dense], **default_args):
-            outputs = X
+            outputs = to_float_images(X)
 
             for _ in range(4):
                 outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
@@ -183,7 +202,7 @@ def omniglot_mlp_conditional_decoder(inputs, z, num_classes, nonlinearity=None,
         batch_size = tf.shape(inputs)[0]
         with arg_scope([dense], **default_args):
 
-            outputs = tf.reshape(inputs, [-1,np.prod(int_shape(inputs)[1:])])
+            outputs = tf.reshape(to_float_images(inputs), [-1,np.prod(int_shape(inputs)[1:])])
             z = tf.tile(z, tf.stack([batch_size, 1]))
             outputs = tf.concat([outputs, z], axis=-1)
             num_units = 512
@@ -212,7 +231,7 @@ def omniglot_conv_conditional_decoder(inputs, z, num_classes, nonlinearity=None,
         stride = [2, 2]
         bsize = tf.shape(inputs)[0]
         with arg_scope([conv2d, dense], **default_args):
-            outputs = inputs
+            outputs = to_float_images(inputs)
 
             # for _ in range(4):
             #     outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
@@ -284,12 +303,18 @@ def aggregator(r, num_c, z_dim, method=tf.reduce_mean, nonlinearity=None, bn=Tru
 
 
 @add_arg_scope
-def cls_aggregator(r, y, z_dim, method=tf.reduce_mean, nonlinearity=None, bn=True, kernel_initializer=None, kernel_regularizer=None, is_training=False, counters={}):
+def cls_aggregator(r, y, z_dim, method=tf.reduce_mean, nonlinearity=None, bn=True, kernel_initializer=None, kernel_regularizer=None, is_training=False, counters={}, num_classes=None):
+    """
+    y is either one-hot or integer class ids, num_classes is needed for the latter
+    """
     name = get_name("cls_aggregator", counters)
     print("construct", name, "...")
     with tf.variable_scope(name):
         with arg_scope([dense], nonlinearity=nonlinearity, bn=bn, kernel_initializer=kernel_initializer, kernel_regularizer=kernel_regularizer, is_training=is_training, counters=counters):
             r_dim = int_shape(r)[-1]
+            if y.dtype.is_integer:
+                r = _segment_aggregate(r, y, num_classes, method)
+                return tf.reshape(r, [1, num_classes*r_dim])
             r_arr = []
             for k in range(int_shape(y)[-1]):
                 r_arr.append(method(tf.tile(y[:, k:k+1], [1,r_dim]) * r, axis=0, keepdims=True))
@@ -3,8 +3,8 @@ import os
 import tensorflow as tf
 from tensorflow.contrib.framework.python.ops import arg_scope, add_arg_scope
 from misc.layers import conv2d, deconv2d, dense
-from misc.helpers import int_shape, get_name, get_trainable_variables
-from misc.metrics import accuracy
+from misc.helpers import int_shape, get_name, get_trainable_variables, to_float_images
+from misc.metrics import accuracy, sparse_accuracy
 
 class MAMLRegressor(object):
 
@@ -12,13 +12,21 @@ class MAMLRegressor(object):
         self.counters = counters
         self.user_mode = user_mode
 
-    def construct(self, regressor, task_type, obs_shape, label_shape=[], num_classes=1, alpha=0.01, inner_iters=1, eval_iters=10, nonlinearity=tf.nn.relu, bn=False, kernel_initializer=None, kernel_regularizer=None):
+    def construct(self, regressor, task_type, obs_shape, label_shape=[], num_classes=1, alpha=0.01, inner_iters=1, eval_iters=10, nonlinearity=tf.nn.relu, bn=False, kernel_initializer=None, kernel_regularizer=None, inputs=None, obs_dtype=tf.float32):
 
         self.regressor = regressor
         self.task_type = task_type
-        if task_type == 'classification':
+        self.label_dtype = tf.float32
+        if task_type == 'classification' and label_shape == []:
+            # integer class ids instead of one-hot labels
+            self.label_dtype = tf.int32
+            self.error_func = tf.losses.sparse_softmax_cross_entropy
+            self.pred_func = lambda x: tf.nn.softmax(x)
+            self.accuracy_func = sparse_accuracy
+        elif task_type == 'classification':
             self.error_func = tf.losses.softmax_cross_entropy
             self.pred_func = lambda x: tf.nn.softmax(x)
+            self.accuracy_func = accuracy
         elif task_type == 'regression':
             self.error_func = tf.losses.mean_squared_error
             self.pred_func = lambda x: x
@@ -35,10 +43,18 @@ class MAMLRegressor(object):
         self.kernel_initializer = kernel_initializer
         self.kernel_regularizer = kernel_regularizer
 
-        self.X_c = tf.placeholder(tf.float32, shape=tuple([None,]+obs_shape))
-        self.y_c = tf.placeholder(tf.float32, shape=tuple([None,]+label_shape))
-        self.X_t = tf.placeholder(tf.float32, shape=tuple([None,]+obs_shape))
-        self.y_t = tf.placeholder(tf.float32, shape=tuple([None,]+label_shape))
+        self.inputs = inputs
+        if inputs is None:
+            self.X_c = tf.placeholder(obs_dtype, shape=tuple([None,]+obs_shape))
+            self.y_c = tf.placeholder(self.label_dtype, shape=tuple([None,]+label_shape))
+            self.X_t = tf.placeholder(obs_dtype, shape=tuple([None,]+obs_shape))
+            self.y_t = tf.placeholder(self.label_dtype, shape=tuple([None,]+label_shape))
+        else:
+            X_c, y_c, X_t, y_t = inputs.tensors
+            self.X_c = tf.placeholder_with_default(X_c, shape=tuple([None,]+obs_shape))
+            self.y_c = tf.placeholder_with_default(y_c, shape=tuple([None,]+label_shape))
+            self.X_t = tf.placeholder_with_default(X_t, shape=tuple([None,]+obs_shape))
+            self.y_t = tf.placeholder_with_default(y_t, shape=tuple([None,]+label_shape))
         self.is_training = tf.placeholder(tf.bool, shape=())
 
         self._model()
@@ -76,7 +92,7 @@ class MAMLRegressor(object):
                 self.y_hat_sqs = [self.pred_func(o) for o in self.outputs_sqs]
                 self.loss_sqs = [self.error_func(self.y_t, o) for o in self.outputs_sqs]
                 if self.task_type == 'classification':
-                    self.acc_sqs = [accuracy(self.y_t, y_hat) for y_hat in self.y_hat_sqs]
+                    self.acc_sqs = [self.accuracy_func(self.y_t, y_hat) for y_hat in self.y_hat_sqs]
 
     def _loss(self):
         return self.loss_sqs[self.inner_iters]
@@ -241,7 +257,7 @@ def omniglot_conv(X, params=None, num_classes=1, nonlinearity=None, bn=True, ker
         filter_size = [3, 3]
         stride = [2, 2]
         with arg_scope([conv2d, dense], **default_args):
-            outputs = X
+            outputs = to_float_images(X)
             if params is None:
                 outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
                 outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
@@ -279,7 +295,7 @@ def miniimagenet_conv(X, params=None, num_classes=1, nonlinearity=None, bn=True,
         }
         num_filters = 32
         with arg_scope([conv2d, dense], **default_args):
-            outputs = X
+            outputs = to_float_images(X, 1./255)
             if params is None:
                 outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
                 outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
@@ -4,10 +4,10 @@ import tensorflow as tf
 from tensorflow.contrib.framework.python.ops import arg_scope, add_arg_scope
 from misc.layers import conv2d, deconv2d, dense
 from misc.samplers import gaussian_sampler
-from misc.helpers import int_shape, get_name, get_trainable_variables
+from misc.helpers import int_shape, get_name, get_trainable_variables, to_float_images
 from misc.estimators import compute_2gaussian_kld
 from misc.losses import mean_squared_error
-from misc.metrics import accuracy
+from misc.metrics import accuracy, sparse_accuracy
 
 
 
@@ -17,15 +17,23 @@ class NeuralProcess(object):
         self.counters = counters
         self.user_mode = user_mode
 
-    def construct(self, sample_encoder, aggregator, conditional_decoder, task_type, obs_shape, r_dim, z_dim, label_shape=[], num_classes=1, nonlinearity=tf.nn.relu, bn=False, kernel_initializer=None, kernel_regularizer=None):
+    def construct(self, sample_encoder, aggregator, conditional_decoder, task_type, obs_shape, r_dim, z_dim, label_shape=[], num_classes=1, nonlinearity=tf.nn.relu, bn=False, kernel_initializer=None, kernel_regularizer=None, inputs=None, obs_dtype=tf.float32):
         #
         self.sample_encoder = sample_encoder
         self.aggregator = aggregator
         self.conditional_decoder = conditional_decoder
         self.task_type = task_type
-        if task_type == 'classification':
+        self.label_dtype = tf.float32
+        if task_type == 'classification' and label_shape == []:
+            # integer class ids instead of one-hot labels
+            self.label_dtype = tf.int32
+            self.error_func = tf.losses.sparse_softmax_cross_entropy
+            self.pred_func = lambda x: tf.nn.softmax(x)
+            self.accuracy_func = sparse_accuracy
+        elif task_type == 'classification':
             self.error_func = tf.losses.softmax_cross_entropy
             self.pred_func = lambda x: tf.nn.softmax(x)
+            self.accuracy_func = accuracy
         elif task_type == 'regression':
             self.error_func = mean_squared_error #tf.losses.mean_squared_error
             self.pred_func = lambda x: x
@@ -41,10 +49,18 @@ class NeuralProcess(object):
         self.kernel_initializer = kernel_initializer
         self.kernel_regularizer = kernel_regularizer
         #
-        self.X_c = tf.placeholder(tf.float32, shape=tuple([None,]+obs_shape))
-        self.y_c = tf.placeholder(tf.float32, shape=tuple([None,]+label_shape))
-        self.X_t = tf.placeholder(tf.float32, shape=tuple([None,]+obs_shape))
-        self.y_t = tf.placeholder(tf.float32, shape=tuple([None,]+label_shape))
+        self.inputs = inputs
+        if inputs is None:
+            self.X_c = tf.placeholder(obs_dtype, shape=tuple([None,]+obs_shape))
+            self.y_c = tf.placeholder(self.label_dtype, shape=tuple([None,]+label_shape))
+            self.X_t = tf.placeholder(obs_dtype, shape=tuple([None,]+obs_shape))
+            self.y_t = tf.placeholder(self.label_dtype, shape=tuple([None,]+label_shape))
+        else:
+            X_c, y_c, X_t, y_t = inputs.tensors
+            self.X_c = tf.placeholder_with_default(X_c, shape=tuple([None,]+obs_shape))
+            self.y_c = tf.placeholder_with_default(y_c, shape=tuple([None,]+label_shape))
+            self.X_t = tf.placeholder_with_default(X_t, shape=tuple([None,]+obs_shape))
+            self.y_t = tf.placeholder_with_default(y_t, shape=tuple([None,]+label_shape))
 
         self.is_training = tf.placeholder(tf.bool, shape=())
         self.use_z_pr = tf.cast(tf.placeholder_with_default(False, shape=()), dtype=tf.float32)
@@ -81,22 +97,28 @@ class NeuralProcess(object):
                     r_ct = self.sample_encoder(X_ct, y_ct, self.r_dim, self.num_classes)
                     self.r_ct = r_ct
                     if self.task_type == 'classification':
-                        self.z_mu_pr, self.z_log_sigma_sq_pr, self.z_mu_pos, self.z_log_sigma_sq_pos = self.aggregator(r_ct, y_ct, num_c, self.z_dim)
+                        self.z_mu_pr, self.z_log_sigma_sq_pr, self.z_mu_pos, self.z_log_sigma_sq_pos = self.aggregator(r_ct, y_ct, num_c, self.z_dim, num_classes=self.num_classes)
                     else:
                         self.z_mu_pr, self.z_log_sigma_sq_pr, self.z_mu_pos, self.z_log_sigma_sq_pos = self.aggregator(r_ct, num_c, self.z_dim)
                     if self.user_mode == 'train':
                         # z = self.z_mu_pr ##
-                        z = gaussian_sampler(self.z_mu_pos, tf.exp(0.5*self.z_log_sigma_sq_pos))
+                        # the standard normal noise of z can be fed, e.g. as +eps/-eps for antithetic evaluation
+                        self.z_eps = tf.placeholder_with_default(tf.random_normal(tf.shape(self.z_mu_pos)), shape=int_shape(self.z_mu_pos))
+                        z = self.z_mu_pos + tf.exp(0.5*self.z_log_sigma_sq_pos) * self.z_eps
                         z_pr = gaussian_sampler(self.z_mu_pr, tf.exp(0.5*self.z_log_sigma_sq_pr))
                     elif self.user_mode == 'eval':
+                        self.z_eps = None
                         z = self.z_mu_pos
                     else:
                         raise Exception("unknown user_mode")
                     z = (1-self.use_z_pr) * z + self.use_z_pr * z_pr
                     self.outputs = self.conditional_decoder(self.X_t, z, self.num_classes)
-                    self.mse = tf.losses.mean_squared_error(self.y_t, self.outputs)
-                    y_sigma = 0.2 ##
-                    self.nll = tf.losses.mean_squared_error(self.y_t, self.outputs) / (2*y_sigma**2)
+                    if self.task_type == 'classification':
+                        self.acc = self.accuracy_func(self.y_t, self.pred_func(self.outputs))
+                    else:
+                        self.mse = tf.losses.mean_squared_error(self.y_t, self.outputs)
+                        y_sigma = 0.2 ##
+                        self.nll = tf.losses.mean_squared_error(self.y_t, self.outputs) / (2*y_sigma**2)
 
     def _loss(self, beta=1., y_sigma=1./np.sqrt(2)):
         self.reg = compute_2gaussian_kld(self.z_mu_pr, self.z_log_sigma_sq_pr, self.z_mu_pos, self.z_log_sigma_sq_pos)
@@ -126,7 +148,7 @@ class NeuralProcess(object):
             self.is_training: False,
         }
         if self.task_type == 'classification':
-            return [self.loss, accuracy(self.y_t, self.pred_func(self.outputs))], feed_dict
+            return [self.loss, self.acc], feed_dict
         return [self.loss, self.mse, self.nll], feed_dict
 
 @add_arg_scope
@@ -147,7 +169,7 @@ def miniimagenet_conv_encoder(X, y, r_dim, num_classes, is_training, nonlinearit
         stride = [2, 2]
         batch_size = tf.shape(X)[0]
         with arg_scope([conv2d, dense], **default_args):
-            outputs = X
+            outputs = to_float_images(X, 1./255)
             for _ in range(4):
                 outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
             outputs = tf.reshape(outputs, [-1, np.prod(int_shape(outputs)[1:])])
@@ -174,7 +196,7 @@ def miniimagenet_conv_conditional_decoder(inputs, z, num_classes, nonlinearity=N
         stride = [2, 2]
         bsize = tf.shape(inputs)[0]
         with arg_scope([conv2d, dense], **default_args):
-            outputs = inputs
+            outputs = to_float_images(inputs, 1./255)
 
             z_tile = tf.tile(tf.reshape(z, [1, 1, 1, int_shape(z)[-1]]), tf.stack([bsize, 84, 84, 1]))
             outputs = tf.concat([outputs, z_tile], axis=-1)
@@ -217,7 +239,7 @@ def omniglot_conv_encoder(X, y, r_dim, num_classes, is_training, nonlinearity=No
         stride = [2, 2]
         batch_size = tf.shape(X)[0]
         with arg_scope([conv2d, dense], **default_args):
-            outputs = X
+            outputs = to_float_images(X)
             for _ in range(4):
                 outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
             outputs = tf.reshape(outputs, [-1, np.prod(int_shape(outputs)[1:])])
@@ -270,7 +292,7 @@ def omniglot_conv_conditional_decoder(inputs, z, num_classes, nonlinearity=None,
         stride = [2, 2]
         bsize = tf.shape(inputs)[0]
         with arg_scope([conv2d, dense], **default_args):
-            outputs = inputs
+            outputs = to_float_images(inputs)
 
             # for _ in range(4):
             #     outputs = conv2d(outputs, num_filters, filter_size=filter_size, stride=stride, pad="SAME")
@@ -340,20 +362,39 @@ def aggregator(r, num_c, z_dim, method=tf.reduce_mean, nonlinearity=None, bn=Tru
 
 
 
+def _segment_aggregate(r, y, num_classes, method):
+    """
+    Per-class sum of the rows of r given class ids y, divided by the number
+    of rows for tf.reduce_mean: the same as method over the rows masked by
+    one-hot labels.
+    """
+    assert method in [tf.reduce_mean, tf.reduce_sum], "class ids can only be aggregated with tf.reduce_mean or tf.reduce_sum"
+    r = tf.unsorted_segment_sum(r, y, num_classes)
+    if method is tf.reduce_mean:
+        r = r / tf.cast(tf.shape(y)[0], r.dtype)
+    return r
+
 @add_arg_scope
-def cls_aggregator(r, y, num_c, z_dim, method=tf.reduce_mean, nonlinearity=None, bn=True, kernel_initializer=None, kernel_regularizer=None, is_training=False, counters={}):
+def cls_aggregator(r, y, num_c, z_dim, method=tf.reduce_mean, nonlinearity=None, bn=True, kernel_initializer=None, kernel_regularizer=None, is_training=False, counters={}, num_classes=None):
+    """
+    y is either one-hot or integer class ids, num_classes is needed for the latter
+    """
     name = get_name("cls_aggregator", counters)
     print("construct", name, "...")
     with tf.variable_scope(name):
         with arg_scope([dense], nonlinearity=nonlinearity, bn=bn, kernel_initializer=kernel_initializer, kernel_regularizer=kernel_regularizer, is_training=is_training, counters=counters):
             r_dim = int_shape(r)[-1]
-            num_classes = int_shape(y)[-1]
-            r_pr_arr, r_arr = [], []
-            for k in range(num_classes):
-                r_pr_arr.append(method(tf.tile(y[:num_c, k:k+1], [1,r_dim]) * r[:num_c], axis=0, keepdims=True))
-                r_arr.append(method(tf.tile(y[:, k:k+1], [1,r_dim]) * r, axis=0, keepdims=True))
-            r_pr = tf.concat(r_pr_arr, axis=0)
-            r = tf.concat(r_arr, axis=0)
+            if y.dtype.is_integer:
+                r_pr = _segment_aggregate(r[:num_c], y[:num_c], num_classes, method)
+                r = _segment_aggregate(r, y, num_classes, method)
+            else:
+                num_classes = int_shape(y)[-1]
+                r_pr_arr, r_arr = [], []
+                for k in range(num_classes):
+                    r_pr_arr.append(method(tf.tile(y[:num_c, k:k+1], [1,r_dim]) * r[:num_c], axis=0, keepdims=True))
+                    r_arr.append(method(tf.tile(y[:, k:k+1], [1,r_dim]) * r, axis=0, keepdims=True))
+                r_pr = tf.concat(r_pr_arr, axis=0)
+                r = tf.concat(r_arr, axis=0)
             r = tf.concat([r_pr, r], axis=0)
 
             num_units = 256
@@ -0,0 +1,42 @@
+"""
+Decode an image dataset once into a packed uint8 store (see data/packed.py).
+
+    python pack_datasets.py omniglot --data_dir /data/ziz/not-backed-up/jxu/omniglot --output /data/ziz/not-backed-up/jxu/omniglot-packed
+
+The store is written to output.npy and output.json. load_data picks it up
+from its default location instead of reading the individual images.
+CelebA is packed per subset next to the image directories of the given
+--size, where CelebA looks for it.
+"""
+import argparse
+import time
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('dataset', help='dataset to pack', choices=['omniglot', 'miniimagenet', 'celeba'])
+    parser.add_argument('--data_dir', help='directory of the original images', required=True)
+    parser.add_argument('--output', help='path of the store, without extension (celeba writes next to its images)', default='')
+    parser.add_argument('--size', help='resolution of the celeba images', default=32, type=int)
+    parser.add_argument('--processes', help='number of decoding processes (all cores by default)', default=None, type=int)
+    return parser
+
+
+def main(args):
+    if args.dataset != 'celeba' and args.output == '':
+        raise Exception("--output is required to pack {0}".format(args.dataset))
+    start_time = time.time()
+    if args.dataset == 'omniglot':
+        from data.omniglot import pack_omniglot
+        pack_omniglot(args.data_dir, args.output, processes=args.processes)
+    elif args.dataset == 'miniimagenet':
+        from data.miniimagenet import pack_miniimagenet
+        pack_miniimagenet(args.data_dir, args.output, processes=args.processes)
+    elif args.dataset == 'celeba':
+        from data.celeba import pack_celeba
+        pack_celeba(args.data_dir, size=args.size, processes=args.processes)
+    print("packed {0} ({1:0.1f}s)".format(args.dataset, time.time()-start_time))
+
+
+if __name__ == '__main__':
+    main(argument_parser().parse_args())
@@ -10,8 +10,11 @@ import tensorflow as tf
 from tensorflow.python import debug as tf_debug
 from args import argument_parser, prepare_args
 from data.load_data import load
+from data.sampling import ShotRange
 from models.maml_regressors import MAMLRegressor, mlp5, mlp2
 from learners.maml_learner import MAMLLearner
+from misc.inputs import in_graph_task_source, PointSetSource
+from misc.episodes import episode_dataset, EpisodeSource
 
 
 parser = argument_parser()
@@ -22,7 +25,10 @@ checkpoint_dir = "/data/ziz/jxu"
 result_dir = "results"
 
 # train_set, val_set = load(dataset_name=args.dataset_name, period_range=[0.5*np.pi, 0.5*np.pi])
-train_set, val_set = load(dataset_name=args.dataset_name)
+load_kwargs = {}
+if args.dataset_name in ['sinusoid', 'gpsamples']:
+    load_kwargs["eval_input_sampling"] = args.eval_input_sampling
+train_set, val_set = load(dataset_name=args.dataset_name, **load_kwargs)
 
 models = [MAMLRegressor(counters={}, user_mode=args.user_mode) for i in range(args.nr_model)]
 
@@ -44,7 +50,17 @@ model = tf.make_template('model', MAMLRegressor.construct)
 
 for i in range(args.nr_model):
     with tf.device('/'+ args.device_type +':%d' % (i%args.nr_gpu)):
-        model(models[i], **model_opt)
+        inputs = None
+        if args.in_graph_tasks:
+            inputs = in_graph_task_source(train_set, args.seed, i, num_shots=10, test_shots=20)
+        elif args.point_set_inputs:
+            inputs = PointSetSource(model_opt["obs_shape"])
+        elif args.input_pipeline == 'tfdata':
+            with tf.device('/cpu:0'):
+                episodes = episode_dataset(model_opt["obs_shape"], train_set, num_shots=10, test_shots=20, record_pattern=args.episode_records,
+                                           seed=args.seed, replica=i, num_replicas=args.nr_model)
+                inputs = EpisodeSource(episodes, model_opt["obs_shape"])
+        model(models[i], inputs=inputs, **model_opt)
 
 #tags = ["test", 'small-period']
 tags = ["test"]
@@ -68,8 +84,8 @@ with tf.Session(config=config) as sess:
         "save_interval": args.save_interval,
         "eval_samples": 1000,
         "meta_batch": args.nr_model,
-        "num_shots": partial(np.random.randint, low=10, high=11),
-        "test_shots": partial(np.random.randint, low=20, high=21),
+        "num_shots": ShotRange(10, 11),
+        "test_shots": ShotRange(20, 21),
         "load_params": args.load_params,
     }
     if args.user_mode == 'train':
@@ -11,9 +11,13 @@ import tensorflow as tf
 from tensorflow.python import debug as tf_debug
 from args import argument_parser, prepare_args
 from data.load_data import load
+from data.sampling import ShotRange
 from models.neural_processes import NeuralProcess
 from learners.np_learner import NPLearner
+from data.gpsample import GPOracle
 from models.neural_processes import fc_encoder, aggregator, conditional_decoder
+from misc.inputs import in_graph_task_source, PointSetSource
+from misc.episodes import episode_dataset, EpisodeSource
 
 parser = argument_parser()
 args = parser.parse_args()
@@ -22,7 +26,10 @@ args = prepare_args(args)
 checkpoint_dir = "/data/ziz/jxu"
 result_dir = "results"
 
-train_set, val_set = load(dataset_name=args.dataset_name)
+load_kwargs = {}
+if args.dataset_name in ['sinusoid', 'gpsamples']:
+    load_kwargs["eval_input_sampling"] = args.eval_input_sampling
+train_set, val_set = load(dataset_name=args.dataset_name, **load_kwargs)
 
 models = [NeuralProcess(counters={}, user_mode=args.user_mode) for i in range(args.nr_model)]
 
@@ -44,7 +51,17 @@ model = tf.make_template('model', NeuralProcess.construct)
 
 for i in range(args.nr_model):
     with tf.device('/'+ args.device_type +':%d' % (i%args.nr_gpu)):
-        model(models[i], **model_opt)
+        inputs = None
+        if args.in_graph_tasks:
+            inputs = in_graph_task_source(train_set, args.seed, i, num_shots=(1, 20), test_shots=(1, 20), include_context=True)
+        elif args.point_set_inputs:
+            inputs = PointSetSource(model_opt["obs_shape"], include_context=True)
+        elif args.input_pipeline == 'tfdata':
+            with tf.device('/cpu:0'):
+                episodes = episode_dataset(model_opt["obs_shape"], train_set, num_shots=(1, 20), test_shots=(1, 20), record_pattern=args.episode_records,
+                                           seed=args.seed, replica=i, num_replicas=args.nr_model)
+                inputs = EpisodeSource(episodes, model_opt["obs_shape"], include_context=True)
+        model(models[i], inputs=inputs, **model_opt)
 
 
 tags = ["test1", "sigma001"]
@@ -52,6 +69,11 @@ tags = ["test1", "sigma001"]
 learner = NPLearner(session=None, parallel_models=models, optimize_op=None, train_set=train_set, eval_set=val_set, variables=tf.trainable_variables(), lr=args.learning_rate, device_type=args.device_type, tags=tags, cdir=checkpoint_dir, rdir=result_dir)
 
 
+gen_num_shots, gen_test_shots = ShotRange(1, 20), ShotRange(1, 20)
+if args.user_mode == 'train' and args.prefetch > 0 and args.prefetch_processes > 0:
+    # fork before TensorFlow starts its threads in tf.Session
+    learner.fork_workers(args.nr_model, gen_num_shots, gen_test_shots, args.prefetch_processes, capacity=args.prefetch, seed=args.seed)
+
 initializer = tf.global_variables_initializer()
 saver = tf.train.Saver()
 
@@ -70,9 +92,16 @@ with tf.Session(config=config) as sess:
         "save_interval": args.save_interval,
         "eval_samples": 1000,
         "meta_batch": args.nr_model,
-        "gen_num_shots": partial(np.random.randint, low=1, high=20),
-        "gen_test_shots": partial(np.random.randint, low=1, high=20),
+        "gen_num_shots": gen_num_shots,
+        "gen_test_shots": gen_test_shots,
         "load_params": args.load_params,
+        "oracle": GPOracle.from_dataset(val_set) if args.dataset_name == 'gpsamples' else None,
+        "eval_seed": args.eval_seed,
+        "antithetic": args.antithetic,
+        "prefetch": args.prefetch,
+        "prefetch_threads": args.prefetch_threads,
+        "prefetch_processes": args.prefetch_processes,
+        "seed": args.seed,
     }
 
     if args.user_mode == 'train':